@@ -0,0 +1,228 @@
+import logging
+import time
+import numpy as np
+from sim import TARGET_FOOD, TARGET_WORKERS, TARGET_PRODUCTS
+
+FIELD = 0
+DINING_HALL = 1
+HOME = 2
+FACTORY = 3
+
+
+def _group_rank(groups: np.ndarray) -> np.ndarray:
+    """Returns the rank of every element within its group,
+    the groups must be sorted"""
+    n = len(groups)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+
+
+def _serve(groups: np.ndarray, cost: np.ndarray,
+           budget: np.ndarray) -> np.ndarray:
+    """Returns a mask of the elements that fit in their group's budget,
+    served in order of appearance"""
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    total = np.cumsum(cost[order])
+    if len(total) > 0:
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:]
+                                      != sorted_groups[:-1]])
+        before = np.r_[0, total][starts]
+        total -= np.repeat(before, np.diff(np.r_[starts, len(total)]))
+    served = np.empty(len(groups), dtype=bool)
+    served[order] = total <= budget[sorted_groups]
+    return served
+
+
+class BatchWorld:
+    """World where places hold their tokens as NumPy arrays and
+    every transition type fires in batches once per tick"""
+    def __init__(self, barrack_size: int, storage_size: int, barn_size: int,
+                 dining_halls_size: int, homes_size: int, fields_size: int,
+                 factories_size: int, workers_size: int, seed: int = None,
+                 target_food: int = TARGET_FOOD,
+                 target_workers: int = TARGET_WORKERS,
+                 target_products: int = TARGET_PRODUCTS):
+        if barrack_size < 1 or storage_size < 1 or barn_size < 1:
+            raise ValueError("At least one barrack, storage and barn needed")
+
+        self._rng = np.random.default_rng(seed)
+        self._tick = 0
+        self._target_food = target_food
+        self._target_workers = target_workers
+        self._target_products = target_products
+
+        start = self._rng.integers(0, barrack_size, workers_size)
+        self._barracks = [np.full(n, 100, dtype=np.int16) for n in
+                          np.bincount(start, minlength=barrack_size)]
+        self._barns = [np.zeros(0) for _ in range(barn_size)]
+        self._storage = np.zeros(storage_size, dtype=np.int64)
+
+        self._types = np.repeat(
+            [DINING_HALL, HOME, FIELD, FACTORY],
+            [dining_halls_size, homes_size, fields_size, factories_size])
+        size = len(self._types)
+        uses_barn = (self._types == DINING_HALL) | (self._types == FIELD)
+        self._barrack_in = self._rng.integers(0, barrack_size, size)
+        self._barrack_out = self._rng.integers(0, barrack_size, size)
+        self._other = np.where(uses_barn,
+                               self._rng.integers(0, barn_size, size),
+                               self._rng.integers(0, storage_size, size))
+        self._closed = np.zeros(size, dtype=bool)
+        self._harm_level = self._rng.integers(0, 10, size)
+        self._priority = np.full(size, 0.5)
+        logging.info("Batch world with %s transitions and %s workers",
+                     size, workers_size)
+
+    @property
+    def tick(self) -> int:
+        """Returns the number of ticks simulated"""
+        return self._tick
+
+    def resource_count(self) -> tuple[int, int, int]:
+        """Counts the number of workers, products and food in the world"""
+        return (sum(len(b) for b in self._barracks),
+                int(self._storage.sum()),
+                sum(len(b) for b in self._barns))
+
+    def _assign(self, source: np.ndarray) -> np.ndarray:
+        """Picks a random open transition on each worker's barrack,
+        -1 where the barrack has none"""
+        open_ids = np.flatnonzero(~self._closed)
+        by_barrack = open_ids[np.argsort(self._barrack_in[open_ids],
+                                         kind="stable")]
+        counts = np.bincount(self._barrack_in[by_barrack],
+                             minlength=len(self._barracks))
+        offsets = np.r_[0, np.cumsum(counts)[:-1]]
+
+        transition = np.full(len(source), -1)
+        has = counts[source] > 0
+        pick = offsets[source[has]] + (self._rng.random(has.sum())
+                                       * counts[source[has]]).astype(int)
+        transition[has] = by_barrack[pick]
+        return transition
+
+    def step(self):
+        """Fires every transition type once as a batch"""
+        rng = self._rng
+        sizes = [len(b) for b in self._barracks]
+        vitality = np.concatenate(self._barracks).astype(np.int32)
+        source = np.repeat(np.arange(len(sizes)), sizes)
+        transition = self._assign(source)
+        kind = np.where(transition >= 0,
+                        self._types[np.maximum(transition, 0)], -1)
+        fired = np.zeros(len(vitality), dtype=bool)
+        change = np.zeros(len(vitality), dtype=np.int32)
+
+        field = np.flatnonzero(kind == FIELD)
+        harm = rng.random(len(field)) > 0.8
+        change[field] = np.where(harm, -rng.integers(30, 80, len(field)), 0)
+        fired[field] = True
+
+        factory = np.flatnonzero(kind == FACTORY)
+        change[factory] = (-40*rng.random(len(factory))**2
+                           - self._harm_level[transition[factory]]
+                           ).astype(np.int32)
+        fired[factory] = True
+        self._storage += np.bincount(self._other[transition[factory]],
+                                     minlength=len(self._storage))
+
+        dining = np.flatnonzero(kind == DINING_HALL)
+        barn = self._other[transition[dining]]
+        food_left = np.array([len(b) for b in self._barns])
+        eats = _serve(barn, np.ones(len(dining)), food_left)
+        dining, barn = dining[eats], barn[eats]
+        order = np.argsort(barn, kind="stable")
+        dining, barn = dining[order], barn[order]
+        food = np.concatenate(self._barns)
+        first_food = np.r_[0, np.cumsum(food_left)[:-1]]
+        quality = food[first_food[barn] + _group_rank(barn)]
+        change[dining] = (np.arctan(6*quality-2)*25).astype(np.int32)
+        fired[dining] = True
+        eaten = np.bincount(barn, minlength=len(self._barns))
+        self._barns = [b[n:] for b, n in zip(self._barns, eaten)]
+
+        home = np.flatnonzero(kind == HOME)
+        storage = self._other[transition[home]]
+        reproduce = rng.random(len(home)) > self._priority[transition[home]]
+        cost = np.where(reproduce, 0.5, 1.0)
+        rests = _serve(storage, cost, self._storage)
+        home, storage = home[rests], storage[rests]
+        reproduce, cost = reproduce[rests], cost[rests]
+        used = np.bincount(storage, weights=cost,
+                           minlength=len(self._storage))
+        self._storage -= np.ceil(used).astype(np.int64)
+        fired[home] = True
+
+        parents = home[reproduce]
+        order = np.argsort(storage[reproduce], kind="stable")
+        parents = parents[order]
+        paired = _group_rank(storage[reproduce][order]) % 2 == 1
+        unpaired = np.ones(len(parents), dtype=bool)
+        unpaired[:-1] = ~paired[1:]
+        unpaired &= ~paired
+        resting = np.r_[home[~reproduce], parents[unpaired]]
+        change[resting] = rng.integers(10, 35, len(resting))
+        born = self._barrack_out[transition[parents[paired]]]
+
+        destination = np.where(fired, self._barrack_out[
+            np.maximum(transition, 0)], source)
+        vitality = np.clip(vitality + change, 0, 100)
+        vitality = np.r_[vitality, np.full(len(born), 100)]
+        destination = np.r_[destination, born]
+        alive = vitality > 0
+        vitality, destination = vitality[alive], destination[alive]
+        order = np.argsort(destination, kind="stable")
+        counts = np.bincount(destination, minlength=len(self._barracks))
+        self._barracks = np.split(vitality[order].astype(np.int16),
+                                  np.cumsum(counts)[:-1])
+
+        farmed = self._other[transition[field]]
+        self._barns = [np.r_[b, rng.random(n)] for b, n in
+                       zip(self._barns, np.bincount(
+                           farmed, minlength=len(self._barns)))]
+
+        self._stabilize()
+        self._tick += 1
+
+    def _stabilize(self):
+        """Closes transitions so that the resources are balanced"""
+        workers_count, product_count, food_count = self.resource_count()
+        alter_home = 0
+        if workers_count > self._target_workers*1.2:
+            alter_home = 0.2
+        elif workers_count < self._target_workers*.8:
+            alter_home = -0.2
+
+        homes = self._types == HOME
+        self._priority[homes] = np.clip(
+            self._priority[homes]
+            + alter_home*self._rng.random(homes.sum()), 0, 1)
+
+        for t_type, resources_count, target in (
+                (HOME, workers_count, self._target_workers),
+                (DINING_HALL, workers_count, self._target_workers),
+                (FIELD, food_count, self._target_food),
+                (FACTORY, product_count, self._target_products)):
+            ids = np.flatnonzero(self._types == t_type)
+            closed_target = min(len(ids)-1, max(0, (int)(
+                len(ids)*(resources_count-target)/target)))
+            self._closed[ids] = np.arange(len(ids)) < closed_target
+
+    def simulate(self, ticks: int) -> list[tuple[int, int, int, int]]:
+        """Runs a number of ticks, returns the resource count per tick"""
+        history = []
+        start_time = time.time()
+        for _ in range(ticks):
+            self.step()
+            history.append((self._tick, *self.resource_count()))
+            if history[-1][1] == 0:
+                break
+
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            logging.info("%s ticks in %.2f s (%.1f ticks/s)",
+                         len(history), elapsed, len(history) / elapsed)
+        return history
@@ -0,0 +1,227 @@
+from collections import deque
+import itertools
+import os
+from random import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from threading import Event, Thread
+from nullgui import NULL_COMPONENT
+from pydb import Analytics, ColumnStore
+import sim
+from simsimsgui import (Coords, GUIArcComponent, GUIPlaceComponent,
+                        GUITokenComponent, GUITransitionComponent)
+from sim import WAIT_TIMEOUT, Food, Place, Product, Resource, Worker
+
+
+def _reservation_worker(place_a: Place, place_b: Place, start_event: Event,
+                        stop_event: Event, counts: list, index: int):
+    """Moves resources between two places with atomic reservations"""
+    start_event.wait()
+    while not stop_event.is_set():
+        starved = Place.reserve_all({place_a: 1, place_b: 1})
+        if starved is not None:
+            starved.wait_for_token(WAIT_TIMEOUT)
+            continue
+        resource_a = place_a.get()
+        resource_b = place_b.get()
+        place_a.add(resource_b)
+        place_b.add(resource_a)
+        counts[index] += 1
+
+
+def bench_reservation(places_size: int = 4, tokens: int = 8,
+                      duration: float = 1.0,
+                      transitions_per_place: tuple = (1, 2, 4, 8, 16, 32)):
+    """Prints reservation throughput as the number of
+    transitions sharing each place grows"""
+    print("transitions/place  firings/s")
+    for per_place in transitions_per_place:
+        places = [Place(NULL_COMPONENT) for _ in range(places_size)]
+        for place in places:
+            for _ in range(tokens):
+                place.add(Resource(NULL_COMPONENT))
+
+        start_event = Event()
+        stop_event = Event()
+        counts = [0] * (places_size * per_place)
+        threads = [Thread(target=_reservation_worker,
+                          args=(places[i % places_size],
+                                places[(i+1) % places_size],
+                                start_event, stop_event, counts, i))
+                   for i in range(len(counts))]
+        for t in threads:
+            t.start()
+        start_time = time.time()
+        start_event.set()
+        time.sleep(duration)
+        stop_event.set()
+        elapsed = time.time() - start_time
+        firings = sum(counts)
+        for t in threads:
+            t.join()
+        print(f"{per_place:17}  {firings/elapsed:9.0f}")
+
+
+def bench_token_memory(tokens: int = 100000):
+    """Prints the bytes allocated per live token, held in a deque like a
+    place holds them. Headless tokens share the null GUI component"""
+    factories = {"Worker": lambda: Worker(NULL_COMPONENT),
+                 "Food": lambda: Food(random(), NULL_COMPONENT),
+                 "Product": lambda: Product(NULL_COMPONENT)}
+    print("token    bytes/token")
+    for name, factory in factories.items():
+        tracemalloc.start()
+        resources = deque()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(tokens):
+            resources.append(factory())
+        size = (tracemalloc.get_traced_memory()[0] - before) / tokens
+        tracemalloc.stop()
+        print(f"{name:8} {size:11.1f}")
+
+
+def bench_allocation(time_limit: float = 20.0, sql_file: str = "bench.db"):
+    """Prints the memory blocks allocated per second by the simulation
+    and the peak traced memory of a headless event engine run, with and
+    without token pooling. Allocations are the growth in traced blocks
+    per line of sim.py between tracemalloc snapshots taken before and
+    after the run"""
+    print("pooling  firings  blocks/s  KiB/s  peak KiB")
+    sim_only = [tracemalloc.Filter(True, sim.__file__)]
+    for pooling in (False, True):
+        world = sim.World(3, 2, 2, 4, 5, 5, 5, 50, sim.ENGINE_EVENTS,
+                          sql_file=sql_file, xlsx_path=None, headless=True,
+                          seed=1, pooling=pooling, time_limit=time_limit)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot().filter_traces(sim_only)
+        start_time = time.time()
+        world.simulate()
+        elapsed = time.time() - start_time
+        after = tracemalloc.take_snapshot().filter_traces(sim_only)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        growth = [stat for stat in after.compare_to(before, "lineno")
+                  if stat.count_diff > 0]
+        blocks = sum(stat.count_diff for stat in growth)
+        size = sum(stat.size_diff for stat in growth)
+        print(f"{str(pooling):7}  {world.firings:7}  {blocks/elapsed:8.0f}"
+              f"  {size/1024/elapsed:5.0f}  {peak/1024:8.0f}")
+
+
+def _size_on_disk(path: str) -> int:
+    """Returns the bytes of a file, or of every file in a directory"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal")
+               if os.path.exists(path + suffix))
+
+
+def bench_analytics(rows: int = 200000):
+    """Prints the rows written and read per second and the bytes per
+    row of the SQLite and the columnar store"""
+    print("store     write rows/s  read rows/s  bytes/row")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, store in (("sqlite", Analytics), ("columns", ColumnStore)):
+            path = os.path.join(directory, name)
+            analytics = store(path, sim.TABLE_NAME)
+            analytics.create_table()
+            start_time = time.perf_counter()
+            for step in range(rows):
+                analytics.add_step(step*100, 50 + step % 7, step % 11,
+                                   step % 13)
+            analytics.flush()
+            write_time = time.perf_counter() - start_time
+            size = _size_on_disk(path)
+
+            start_time = time.perf_counter()
+            if store is ColumnStore:
+                time_column = analytics.columns()[0]
+            else:
+                time_column = [row[0] for row in analytics.get_steps()]
+            read_time = time.perf_counter() - start_time
+            assert len(time_column) == rows
+            analytics.close()
+            print(f"{name:8} {rows/write_time:13.0f} {rows/read_time:12.0f}"
+                  f" {size/rows:10.1f}")
+
+
+class _QueueCanvas:
+    """Canvas stand-in that only takes the components to draw,
+    so the GUI components can be timed without a display"""
+    def draw_component(self, component):
+        pass
+
+
+def _per_call(action, calls: int) -> float:
+    """Returns the microseconds per call of an action"""
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        action()
+    return (time.perf_counter() - start_time) / calls * 1e6
+
+
+def bench_coords(calls: int = 200000):
+    """Prints the cost of creating and translating coordinates"""
+    point = Coords(10.0, 20.0)
+    offset = Coords(1.0, 2.0)
+    print(f"Coords(x, y)           "
+          f"{_per_call(lambda: Coords(1.0, 2.0), calls):6.2f} us")
+    print(f"translate(Coords)      "
+          f"{_per_call(lambda: point.translate(offset), calls):6.2f} us")
+    print(f"translate(dx, dy)      "
+          f"{_per_call(lambda: point.translate(1.0, 2.0), calls):6.2f} us")
+
+
+def bench_reposition(tokens: int = 100, arcs: int = 200, frames: int = 500):
+    """Prints the microseconds per frame of moving a node holding tokens,
+    and of updating the position of arcs"""
+    canvas = _QueueCanvas()
+    node = GUIPlaceComponent(canvas, {"token_limit": tokens})
+    for _ in range(tokens):
+        node.add_token(GUITokenComponent(canvas))
+    positions = [Coords(100.0 + frame % 2, 100.0) for frame in range(2)]
+    frame = itertools.count()
+
+    def move():
+        node.position = positions[next(frame) % 2]
+    print(f"_reposition, {tokens} tokens  {_per_call(move, frames):8.1f} us")
+
+    hub = GUIPlaceComponent(canvas)
+    arc_list = []
+    for i in range(arcs):
+        transition = GUITransitionComponent(canvas)
+        transition.position = Coords(i, 2*i)
+        arc = GUIArcComponent(canvas, hub, transition)
+        arc._in, arc._out = hub, transition
+        arc_list.append(arc)
+
+    def update_arcs():
+        hub.position = positions[next(frame) % 2]
+        for arc in arc_list:
+            arc.update_position()
+    print(f"update_position, {arcs} arcs "
+          f"{_per_call(update_arcs, frames):8.1f} us")
+
+
+BENCHMARKS = {"reservation": bench_reservation,
+              "token_memory": bench_token_memory,
+              "allocation": bench_allocation,
+              "analytics": bench_analytics,
+              "coords": bench_coords,
+              "reposition": bench_reposition}
+
+
+def main():
+    """Runs the benchmarks named on the command line, or all of them"""
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
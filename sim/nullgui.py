@@ -0,0 +1,65 @@
+''' A GUI backend that draws nothing, for headless SimSims runs '''
+
+
+class NullComponent:
+    ''' A ui component with the GUIPlaceComponent, GUITransitionComponent
+        and GUITokenComponent interface that does nothing.
+    '''
+
+    def add_token(self, token_ui):
+        pass
+
+    def remove_token(self, token_ui):
+        pass
+
+    def autoplace(self, index, n_places):
+        pass
+
+    def update_properties(self, properties):
+        pass
+
+
+NULL_COMPONENT = NullComponent()
+
+
+class NullGUI:
+    ''' A GUI with the SimSimsGUI interface that does nothing.
+        Every ui it creates is the shared NULL_COMPONENT.
+    '''
+
+    def __init__(self, w=400, h=400):
+        self._is_alive = True
+
+    @property
+    def is_alive(self):
+        return self._is_alive
+
+    def create_token_gui(self, properties={}):
+        return NULL_COMPONENT
+
+    def create_place_gui(self, properties={}):
+        return NULL_COMPONENT
+
+    def create_transition_gui(self, properties={}):
+        return NULL_COMPONENT
+
+    def connect(self, src_ui, dst_ui, properties={}):
+        pass
+
+    def disconnect(self, src_ui, dst_ui):
+        pass
+
+    def remove(self, gui):
+        pass
+
+    def on_close(self, fkn):
+        pass
+
+    def start(self):
+        pass
+
+    def update(self):
+        pass
+
+    def close(self):
+        self._is_alive = False
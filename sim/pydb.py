@@ -1,28 +1,154 @@
+import glob
+import os
 import sqlite3
 from sqlite3 import Error
+import tempfile
+from time import monotonic
+import numpy as np
 from openpyxl import Workbook, load_workbook
 from matplotlib import pyplot
+from matplotlib.figure import Figure
+
+XLSX_CHUNK = 10000
+CHUNK_ROWS = 65536
+TAIL_ROW_SIZE = 16
+PLOT_POINTS = 2000
+FIGURE_PATH = "file.png"
+
+
+def _write_sheet(xlsx_path: str, table_name: str, rows):
+    """Replaces the table's sheet in an xlsx file with the rows"""
+    if os.path.exists(xlsx_path):
+        wb = load_workbook(xlsx_path)
+    else:
+        wb = Workbook()
+        wb.remove(wb.active)
+
+    if table_name in wb.sheetnames:
+        wb.remove(wb[table_name])
+    ws = wb.create_sheet(table_name)
+    for row in rows:
+        ws.append(row)
+    wb.save(xlsx_path)
+
+
+def _stream_sheet(xlsx_path: str, sheet_name: str, rows):
+    """Writes the rows to a sheet of an xlsx file with a write-only
+    workbook, replacing a sheet with the same name. The other sheets
+    already in the file are streamed over row by row, so memory stays
+    bounded however many rows there are"""
+    wb = Workbook(write_only=True)
+    old_wb = None
+    if os.path.exists(xlsx_path):
+        old_wb = load_workbook(xlsx_path, read_only=True)
+        for old_ws in old_wb.worksheets:
+            if old_ws.title != sheet_name:
+                ws = wb.create_sheet(old_ws.title)
+                for row in old_ws.values:
+                    ws.append(row)
+    ws = wb.create_sheet(sheet_name)
+    for row in rows:
+        ws.append(row)
+
+    fd, tmp_path = tempfile.mkstemp(
+        suffix=".xlsx", dir=os.path.dirname(os.path.abspath(xlsx_path)))
+    os.close(fd)
+    wb.save(tmp_path)
+    if old_wb is not None:
+        old_wb.close()
+    os.replace(tmp_path, xlsx_path)
+
+
+def _minmax_buckets(time: np.ndarray, column: np.ndarray,
+                    max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    """Downsamples a column to at most max_points points by keeping the
+    rows of the min and max value of each bucket, in time order, so a
+    falling bucket is still drawn falling"""
+    size = len(time)
+    buckets = max_points // 2
+    if size <= max_points or buckets < 1:
+        return time, column
+
+    bucket = np.arange(size) * buckets // size
+    starts = np.flatnonzero(np.diff(bucket, prepend=-1))
+    extrema = []
+    for reduce in (np.minimum, np.maximum):
+        hits = np.flatnonzero(
+            column == reduce.reduceat(column, starts)[bucket])
+        _, first = np.unique(bucket[hits], return_index=True)
+        extrema.append(hits[first])
+    rows = np.unique(np.concatenate(extrema))
+    return time[rows], column[rows]
+
+
+def _plot(workers, products, food, path: str = FIGURE_PATH,
+          show: bool = True):
+    """Saves a graph of the resources over time to a file, showing it
+    first unless show is False. Every resource is a (time, amount) pair
+    of sequences. A figure that is not shown is drawn without pyplot,
+    so no display is needed"""
+    if show:
+        fig, ax = pyplot.subplots()
+    else:
+        fig = Figure()
+        ax = fig.subplots()
+    ax.plot(*workers, label='Workers')
+    ax.plot(*products, label='Products')
+    ax.plot(*food, label='Food')
+
+    ax.set_title('Resources')
+    ax.set_ylabel('Amount')
+    ax.set_xlabel('Time (ms)')
+    ax.legend()
+
+    fig.tight_layout()
+    if show:
+        pyplot.show()
+
+    fig.savefig(path)
+    if show:
+        pyplot.close(fig)
 
 
 class Analytics:
     """Class that can stora data in a database,
-    and export the data into graphs and xlsx"""
-    def __init__(self, path_db, table_name):
+    and export the data into graphs and xlsx.
+    Rows are buffered and committed in groups of batch_size rows,
+    or when flush_interval seconds have passed since the last commit"""
+    def __init__(self, path_db, table_name, batch_size: int = 500,
+                 flush_interval: float = 1.0):
         self._connection = self._create_connection(path_db)
         self._cursor = self._connection.cursor()
         self._table_name = table_name
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = monotonic()
 
     def add_step(self, time: int, workers: int, products: int, food: int):
         """Add a row to the database"""
-        self._cursor.execute(f"INSERT INTO {self._table_name}\
-                             VALUES ({time}, {workers}, {products}, {food})")
-        self._connection.commit()
+        self._buffer.append((time, workers, products, food))
+        if (len(self._buffer) >= self._batch_size
+                or monotonic() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows to the database"""
+        if self._buffer:
+            self._cursor.executemany(
+                f"INSERT INTO {self._table_name} VALUES (?, ?, ?, ?)",
+                self._buffer)
+            self._connection.commit()
+            self._buffer.clear()
+        self._last_flush = monotonic()
 
     def _create_connection(self, db_file):
         """Create a sqlite3 database"""
         conn = None
         try:
             conn = sqlite3.connect(db_file)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
             return conn
         except Error as e:
             print(e)
@@ -41,48 +167,282 @@ class Analytics:
         self._cursor.execute(sql_drop_table)
         self._cursor.execute(sql_create_table)
 
-    def save_to_xlsx(self, xlsx_path: str):
-        """Saves a database table to xlsx"""
-        sql_select = f"SELECT * FROM {self._table_name}"
+    def get_steps(self) -> list[tuple[int, int, int, int]]:
+        """Returns every row in the table ordered by time"""
+        self.flush()
+        sql_select = f"SELECT * FROM {self._table_name} ORDER BY time"
         self._cursor.execute(sql_select)
-        rows = self._cursor.fetchall()
+        return self._cursor.fetchall()
 
-        try:
-            wb = load_workbook(xlsx_path)
-        except Error as e:
-            print(e)
-            wb = Workbook()
+    def _stream_steps(self):
+        """Yields every row ordered by time, fetched XLSX_CHUNK at a time"""
+        self.flush()
+        cursor = self._connection.cursor()
+        cursor.execute(f"SELECT * FROM {self._table_name} ORDER BY time")
+        while True:
+            rows = cursor.fetchmany(XLSX_CHUNK)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
 
-        if self._table_name in wb.sheetnames:
-            wb.remove(wb[self._table_name])
-        ws = wb.create_sheet(self._table_name)
-        for row in rows:
-            ws.append(row)
-        wb.save(xlsx_path)
+    def save_to_xlsx(self, xlsx_path: str, sheet_name: str = None,
+                     streaming: bool = False):
+        """Saves a database table to xlsx, in a sheet named after the
+        table unless a sheet name is given. Streaming writes the rows
+        as they are read, with bounded memory"""
+        sheet_name = sheet_name or self._table_name
+        if streaming:
+            _stream_sheet(xlsx_path, sheet_name, self._stream_steps())
+            return
 
-    def to_figure(self):
-        """Export the database data to a graph"""
+        self.flush()
         sql_select = f"SELECT * FROM {self._table_name}"
         self._cursor.execute(sql_select)
-        data = self._cursor.fetchall()
+        _write_sheet(xlsx_path, sheet_name, self._cursor.fetchall())
 
-        arr_step = [row[0] for row in data]
-        arr_workers = [row[1] for row in data]
-        arr_products = [row[2] for row in data]
-        arr_food = [row[3] for row in data]
+    def close(self):
+        """Writes the buffered rows and closes the database connection"""
+        self.flush()
+        self._connection.close()
 
-        fig, ax = pyplot.subplots()
-        ax.plot(arr_step, arr_workers, label='Workers')
-        ax.plot(arr_step, arr_products, label='Products')
-        ax.plot(arr_step, arr_food, label='Food')
+    def _downsampled_columns(self, max_points: int) -> list[tuple]:
+        """Returns the workers, products and food as (time, amount)
+        pairs of at most max_points points. Longer tables are split
+        into max_points/2 buckets with a window query, and every bucket
+        gives the rows of the min and max of each column in time order"""
+        self.flush()
+        self._cursor.execute(f"SELECT COUNT(*) FROM {self._table_name}")
+        buckets = max_points // 2
+        if self._cursor.fetchone()[0] <= max_points or buckets < 1:
+            data = self.get_steps()
+            time = [row[0] for row in data]
+            return [(time, [row[i] for row in data]) for i in range(1, 4)]
 
-        ax.set_title('Resources')
-        ax.set_ylabel('Amount')
-        ax.set_xlabel('Time (ms)')
-        ax.legend()
+        columns = []
+        for column in ("workers", "products", "food"):
+            sql_select = f"""
+                SELECT time, {column} FROM (
+                    SELECT time, {column},
+                           ROW_NUMBER() OVER (PARTITION BY bucket
+                               ORDER BY {column}, time) AS low,
+                           ROW_NUMBER() OVER (PARTITION BY bucket
+                               ORDER BY {column} DESC, time) AS high
+                    FROM (SELECT time, {column},
+                                 NTILE({buckets}) OVER (ORDER BY time)
+                                 AS bucket
+                          FROM {self._table_name}))
+                WHERE low = 1 OR high = 1 ORDER BY time"""
+            self._cursor.execute(sql_select)
+            data = self._cursor.fetchall()
+            columns.append(([row[0] for row in data],
+                            [row[1] for row in data]))
+        return columns
 
-        fig.tight_layout()
-        pyplot.show()
+    def to_figure(self, max_points: int = PLOT_POINTS,
+                  path: str = FIGURE_PATH, show: bool = True):
+        """Export the database data to a graph of at most max_points
+        points per resource"""
+        _plot(*self._downsampled_columns(max_points), path, show)
 
-        fig.savefig("file.png")
-        pyplot.close(fig)
+
+class ColumnStore:
+    """Append-only store with the Analytics interface that keeps the
+    steps as columns in a directory of .npy chunks of CHUNK_ROWS rows.
+    A chunk is an int32 array of shape (4, rows) holding the time as
+    deltas from the previous step, then workers, products and food.
+    Flushed rows are appended to a tail file, one int32 row per step,
+    that becomes a chunk once it holds CHUNK_ROWS rows. The time of the
+    last step is kept in a small file so the store opens without
+    reading the chunks, which are memory-mapped when read"""
+    def __init__(self, path_dir, table_name, batch_size: int = 500,
+                 flush_interval: float = 1.0):
+        os.makedirs(path_dir, exist_ok=True)
+        self._path_dir = path_dir
+        self._table_name = table_name
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._chunks = len(self._chunk_paths())
+        self._tail = open(self._path(".tail"), "ab")
+        self._tail_rows = self._tail.tell() // TAIL_ROW_SIZE
+        self._last = open(self._path(".last"), "a+", encoding="ascii")
+        self._last_time = self._read_last_time()
+        self._last_flush = monotonic()
+
+    def _path(self, suffix: str) -> str:
+        """Returns the path of one of the table's files"""
+        return os.path.join(self._path_dir, self._table_name + suffix)
+
+    def _chunk_paths(self) -> list[str]:
+        """Returns the table's chunk files in the order written"""
+        return sorted(glob.glob(os.path.join(
+            self._path_dir, f"{self._table_name}-*.npy")))
+
+    def _read_last_time(self) -> int:
+        """Returns the time of the last stored step, 0 if none"""
+        self._last.seek(0)
+        try:
+            return int(self._last.read())
+        except ValueError:
+            return 0
+
+    def _write_last_time(self):
+        """Stores the time of the last step"""
+        self._last.truncate(0)
+        self._last.write(str(self._last_time))
+        self._last.flush()
+
+    def add_step(self, time: int, workers: int, products: int, food: int):
+        """Add a row to the store"""
+        self._buffer.append((time, workers, products, food))
+        if (len(self._buffer) >= self._batch_size
+                or monotonic() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered rows to the tail, which is written as a
+        chunk once it holds CHUNK_ROWS rows"""
+        if self._buffer:
+            rows = np.array(self._buffer, dtype=np.int64)
+            time = rows[:, 0].copy()
+            rows[:, 0] = np.diff(time, prepend=self._last_time)
+            self._last_time = int(time[-1])
+            self._tail.write(rows.astype(np.int32).tobytes())
+            self._tail.flush()
+            self._tail_rows += len(rows)
+            self._buffer.clear()
+            self._write_last_time()
+            if self._tail_rows >= CHUNK_ROWS:
+                self._roll()
+        self._last_flush = monotonic()
+
+    def _roll(self):
+        """Writes the tail as a chunk and empties it"""
+        path = os.path.join(self._path_dir,
+                            f"{self._table_name}-{self._chunks:08d}.npy")
+        np.save(path, np.ascontiguousarray(self._read_tail()))
+        self._chunks += 1
+        self._tail.truncate(0)
+        self._tail_rows = 0
+
+    def _read_tail(self) -> np.ndarray:
+        """Returns the rows in the tail as a (4, rows) array"""
+        return np.fromfile(self._path(".tail"), dtype=np.int32,
+                           count=4*self._tail_rows).reshape(-1, 4).T
+
+    def _tables(self):
+        """Yields the chunks in the order written, then the tail"""
+        for path in self._chunk_paths():
+            yield np.load(path, mmap_mode="r")
+        if self._tail_rows:
+            yield self._read_tail()
+
+    def create_table(self):
+        """Removes the table's rows"""
+        for path in self._chunk_paths():
+            os.remove(path)
+        self._tail.truncate(0)
+        self._buffer.clear()
+        self._chunks = 0
+        self._tail_rows = 0
+        self._last_time = 0
+        self._write_last_time()
+
+    def columns(self) -> tuple[np.ndarray, np.ndarray,
+                               np.ndarray, np.ndarray]:
+        """Returns the time, workers, products and food columns"""
+        self.flush()
+        tables = list(self._tables())
+        if not tables:
+            return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+        table = np.concatenate(tables, axis=1)
+        return (np.cumsum(table[0], dtype=np.int64),
+                table[1], table[2], table[3])
+
+    def get_steps(self) -> list[tuple[int, int, int, int]]:
+        """Returns every row ordered by time"""
+        return list(zip(*(column.tolist() for column in self.columns())))
+
+    def _stream_steps(self):
+        """Yields every row ordered by time, one chunk at a time"""
+        self.flush()
+        last_time = 0
+        for chunk in self._tables():
+            time = last_time + np.cumsum(chunk[0], dtype=np.int64)
+            last_time = int(time[-1])
+            for start in range(0, len(time), XLSX_CHUNK):
+                end = start + XLSX_CHUNK
+                yield from zip(time[start:end].tolist(),
+                               chunk[1, start:end].tolist(),
+                               chunk[2, start:end].tolist(),
+                               chunk[3, start:end].tolist())
+
+    def save_to_xlsx(self, xlsx_path: str, sheet_name: str = None,
+                     streaming: bool = False):
+        """Saves the table to xlsx, in a sheet named after the table
+        unless a sheet name is given. Streaming writes the rows chunk
+        by chunk, with bounded memory"""
+        sheet_name = sheet_name or self._table_name
+        if streaming:
+            _stream_sheet(xlsx_path, sheet_name, self._stream_steps())
+        else:
+            _write_sheet(xlsx_path, sheet_name, self._stream_steps())
+
+    def close(self):
+        """Writes the buffered rows and closes the tail"""
+        self.flush()
+        self._tail.close()
+        self._last.close()
+
+    def to_figure(self, max_points: int = PLOT_POINTS,
+                  path: str = FIGURE_PATH, show: bool = True):
+        """Export the stored data to a graph of at most max_points
+        points per resource"""
+        time, *columns = self.columns()
+        _plot(*(_minmax_buckets(time, column, max_points)
+                for column in columns), path, show)
+
+
+class SweepStore:
+    """Class that stores the time series of many simulation runs
+    in one database"""
+    def __init__(self, path_db):
+        self._connection = sqlite3.connect(path_db)
+        self._cursor = self._connection.cursor()
+
+    def create_tables(self):
+        """Create the run and step tables in the database"""
+        self._cursor.execute("DROP TABLE IF EXISTS Runs")
+        self._cursor.execute("DROP TABLE IF EXISTS Steps")
+        self._cursor.execute("""
+            CREATE TABLE Runs (
+                run INT PRIMARY KEY,
+                seed INT,
+                config TEXT,
+                firings_per_second REAL
+        );""")
+        self._cursor.execute("""
+            CREATE TABLE Steps (
+                run INT,
+                time INT,
+                workers INT,
+                products INT,
+                food INT,
+                PRIMARY KEY (run, time)
+        );""")
+        self._connection.commit()
+
+    def add_run(self, run: int, seed: int, config: str,
+                firings_per_second: float,
+                steps: list[tuple[int, int, int, int]]):
+        """Add one run and its time series to the database"""
+        self._cursor.execute("INSERT INTO Runs VALUES (?, ?, ?, ?)",
+                             (run, seed, config, firings_per_second))
+        self._cursor.executemany("INSERT INTO Steps VALUES (?, ?, ?, ?, ?)",
+                                 [(run, *step) for step in steps])
+        self._connection.commit()
+
+    def close(self):
+        """Closes the database connection"""
+        self._connection.close()
@@ -0,0 +1,291 @@
+from collections import deque
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+from threading import Thread
+import time
+from sim import (ENGINE_THREADS, SQL_FILE, TABLE_NAME, TARGET_FOOD,
+                 TARGET_PRODUCTS, TARGET_WORKERS, TIME_LIMIT, XLSX_PATH,
+                 Barrack, Place, Transition, Worker, World)
+from nullgui import NULL_COMPONENT
+from pydb import Analytics
+
+TRANSFER_INTERVAL = 0.05
+REPORT_INTERVAL = 0.1
+
+
+def split(size: int, shards: int) -> list[int]:
+    """Splits a number of places or transitions as evenly as possible"""
+    return [size//shards + (shard < size % shards)
+            for shard in range(shards)]
+
+
+class RemoteBarrack(Barrack):
+    """Stand-in for a barrack owned by another shard. Workers added to it
+    are buffered as (barrack, vitality) and sent over to that shard"""
+    def __init__(self, shard: int, barrack: int):
+        super().__init__(NULL_COMPONENT)
+        self.shard = shard
+        self._barrack = barrack
+        self.outbox = deque()
+
+    def add(self, worker: Worker) -> bool:
+        """Buffers a living worker for its shard, always returns False
+        since the token itself stays behind"""
+        if worker.vitality > 0:
+            self.outbox.append((self._barrack, worker.vitality))
+        return False
+
+
+class ShardWorld(World):
+    """World owning one shard of the places and transitions. Transitions
+    may send workers to barracks of other shards, the shard stops when
+    the coordinator tells it to. The shard keeps exchanging workers
+    until the coordinator has seen every sent worker received"""
+    def __init__(self, shard: int, shards: int, barracks: list[int],
+                 inboxes: list[multiprocessing.Queue],
+                 reports: multiprocessing.Queue,
+                 stop: multiprocessing.Event,
+                 drained: multiprocessing.Event, *args, **kwargs):
+        self._shard = shard
+        self._inbox = inboxes[shard]
+        self._inboxes = inboxes
+        self._reports = reports
+        self._shared_stop = stop
+        self._drained = drained
+        self._sent = 0
+        self._received = 0
+        self._remote = [RemoteBarrack(other, i)
+                        for other in range(shards) if other != shard
+                        for i in range(barracks[other])]
+        super().__init__(*args, **kwargs)
+
+    def _barracks_out(self) -> list[Barrack]:
+        """Returns both the own barracks and those of other shards"""
+        return self._barracks + self._remote
+
+    def _is_finished(self) -> bool:
+        """Returns True when the coordinator has stopped the shards,
+        a shard without workers may still receive some"""
+        return self._shared_stop.is_set()
+
+    def _reconnect(self, t: Transition, barrack_in: Barrack,
+                   barrack_out: Barrack, place_other: Place):
+        """Connects a transition to new places, keeping arcs to other
+        shards since they are part of the partition"""
+        if isinstance(t.barrack_out, RemoteBarrack):
+            barrack_out = t.barrack_out
+        super()._reconnect(t, barrack_in, barrack_out, place_other)
+
+    def _receive(self):
+        """Adds the workers sent by other shards to the own barracks"""
+        while True:
+            try:
+                batch = self._inbox.get_nowait()
+            except queue.Empty:
+                return
+            for barrack, vitality in batch:
+                worker = self._pools[Worker].acquire()
+                worker.change_vitality(vitality - worker.vitality)
+                self._barracks[barrack].add(worker)
+            self._received += len(batch)
+
+    def _send(self):
+        """Sends the buffered workers, one batch per remote barrack"""
+        for remote in self._remote:
+            if remote.outbox:
+                batch = [remote.outbox.popleft()
+                         for _ in range(len(remote.outbox))]
+                self._inboxes[remote.shard].put(batch)
+                self._sent += len(batch)
+
+    def _report(self, stopped: bool = False, done: bool = False):
+        """Sends the shard's resource count, firings and the number of
+        workers sent and received so far to the coordinator. Workers
+        buffered to be sent are counted as the shard's own"""
+        workers, products, food = self.resource_count()
+        workers += sum(len(remote.outbox) for remote in self._remote)
+        self._reports.put((self._shard, stopped, done, workers, products,
+                           food, self.firings, self._sent, self._received))
+
+    def _transfer(self):
+        """Exchanges workers with the other shards and reports to the
+        coordinator until stopped"""
+        last_report = 0.0
+        while not self._stop_event.is_set():
+            self._receive()
+            self._send()
+            if time.time() - last_report > REPORT_INTERVAL:
+                self._report()
+                last_report = time.time()
+            time.sleep(TRANSFER_INTERVAL)
+
+    def _drain(self):
+        """Keeps exchanging workers after the shard has stopped, until
+        the coordinator has seen every sent worker received"""
+        while True:
+            self._receive()
+            self._send()
+            self._report(stopped=True)
+            if self._drained.wait(REPORT_INTERVAL):
+                return
+
+    def simulate(self):
+        """Runs the shard's world while exchanging workers"""
+        if self.stop:
+            return
+        transfer = Thread(target=self._transfer)
+        transfer.start()
+        super().simulate()
+        transfer.join()
+        self._drain()
+        self._report(stopped=True, done=True)
+
+
+def _run_shard(shard: int, shards: int, barracks: list[int],
+               inboxes: list[multiprocessing.Queue],
+               reports: multiprocessing.Queue, stop: multiprocessing.Event,
+               drained: multiprocessing.Event, args: list[int],
+               kwargs: dict):
+    """Builds and simulates one shard in this process"""
+    with tempfile.TemporaryDirectory() as directory:
+        world = ShardWorld(shard, shards, barracks, inboxes, reports, stop,
+                           drained, *args, engine=ENGINE_THREADS,
+                           headless=True,
+                           sql_file=os.path.join(directory, "shard.db"),
+                           xlsx_path=None, **kwargs)
+        world.simulate()
+
+
+class ShardedWorld:
+    """World whose places and transitions are partitioned over a number
+    of processes. Every shard gets its share of every place, transition
+    and worker, and of the resource targets. Workers cross shards when
+    a transition sends them to a barrack of another shard"""
+    def __init__(self, shards: int, barrack_size: int, storage_size: int,
+                 barn_size: int, dining_halls_size: int, homes_size: int,
+                 fields_size: int, factories_size: int, workers_size: int,
+                 target_food: int = TARGET_FOOD,
+                 target_workers: int = TARGET_WORKERS,
+                 target_products: int = TARGET_PRODUCTS,
+                 sql_file: str = SQL_FILE, xlsx_path: str = XLSX_PATH,
+                 seed: int = None, time_limit: float = TIME_LIMIT):
+        if min(barrack_size, storage_size, barn_size) < shards:
+            raise ValueError("Every shard needs a barrack, storage and barn")
+
+        self.firings_per_second = 0.0
+        self.firings = 0
+        self._shards = shards
+        self._sql_file = sql_file
+        self._xlsx_path = xlsx_path
+        self._time_limit = time_limit
+        self._barracks = split(barrack_size, shards)
+        sizes = [self._barracks] + [split(size, shards) for size in (
+            storage_size, barn_size, dining_halls_size, homes_size,
+            fields_size, factories_size, workers_size)]
+        self._args = list(zip(*sizes))
+        self._kwargs = [{"target_food": food, "target_workers": workers,
+                         "target_products": products,
+                         "seed": None if seed is None else seed + shard,
+                         "time_limit": time_limit}
+                        for shard, (food, workers, products) in enumerate(zip(
+                            split(target_food, shards),
+                            split(target_workers, shards),
+                            split(target_products, shards)))]
+        self._counts = [(0, 0, 0, 0, 0, 0)] * shards
+
+    def resource_count(self) -> tuple[int, int, int]:
+        """Returns the number of workers, products and food over all
+        shards as last reported. Workers sent but not yet received are
+        counted from the sent and received totals, which every shard
+        reports together with its own count"""
+        workers, products, food = (sum(count[i] for count in self._counts)
+                                   for i in range(3))
+        return (workers + self._in_flight(), products, food)
+
+    def _in_flight(self) -> int:
+        """Returns the number of workers sent but not yet received, as
+        last reported"""
+        return (sum(count[4] for count in self._counts)
+                - sum(count[5] for count in self._counts))
+
+    def simulate(self):
+        """Starts one process per shard and records the total resource
+        count until the time limit or every worker is dead"""
+        inboxes = [multiprocessing.Queue() for _ in range(self._shards)]
+        reports = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        drained = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=_run_shard, args=(
+            shard, self._shards, self._barracks, inboxes, reports, stop,
+            drained, self._args[shard], self._kwargs[shard]))
+            for shard in range(self._shards)]
+
+        analytics = Analytics(self._sql_file, TABLE_NAME)
+        analytics.create_table()
+        start_time = time.time()
+        for process in processes:
+            process.start()
+
+        reported = set()
+        stopped = set()
+        done = set()
+        last_step = 0.0
+        while len(done) < self._shards:
+            try:
+                shard, shard_stopped, finished, *counts = reports.get(
+                    timeout=REPORT_INTERVAL)
+                self._counts[shard] = tuple(counts)
+                reported.add(shard)
+                if shard_stopped:
+                    stopped.add(shard)
+                if finished:
+                    done.add(shard)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+
+            elapsed = time.time() - start_time
+            if len(reported) == self._shards and elapsed - last_step > 0.1:
+                analytics.add_step((int)(elapsed*1000),
+                                   *self.resource_count())
+                last_step = elapsed
+            if not stop.is_set() and (elapsed > self._time_limit or (
+                    len(reported) == self._shards
+                    and self.resource_count()[0] == 0)):
+                logging.info("Sim finished")
+                stop.set()
+            if len(stopped) == self._shards and self._in_flight() == 0:
+                drained.set()
+
+        elapsed = time.time() - start_time
+        for process in processes:
+            process.join()
+        if self._xlsx_path is not None:
+            analytics.save_to_xlsx(self._xlsx_path, streaming=True)
+        analytics.close()
+
+        self.firings = sum(count[3] for count in self._counts)
+        if elapsed > 0:
+            self.firings_per_second = self.firings / elapsed
+        logging.info("%s shards, %s firings in %.2f s (%.0f firings/s)",
+                     self._shards, self.firings, elapsed,
+                     self.firings_per_second)
+
+
+def main():
+    """Main function"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    shards = os.cpu_count() or 1
+    world = ShardedWorld(shards, 3*shards, 2*shards, 2*shards, 4*shards,
+                         5*shards, 5*shards, 5*shards, 50*shards,
+                         target_food=40*shards, target_workers=40*shards,
+                         target_products=50*shards, xlsx_path=None)
+    world.simulate()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,69 @@
 from collections import deque
-from random import randrange, random
-from typing import Type
+from contextlib import nullcontext
+import asyncio
+from random import Random
+from typing import Callable, Type
+import heapq
+import itertools
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import math
-from threading import Thread, Event, Lock
+import queue
+from threading import Condition, Thread, Event, Lock
 import time
 from simsimsgui import GUIPlaceComponent as GuiComp, SimSimsGUI
-from pydb import Analytics
+from nullgui import NullGUI
+from pydb import Analytics, ColumnStore
 
 COLOR_FOOD = "#11aa22"
 COLOR_WORKER = "#1122aa"
 COLOR_PRODUCT = "#ee3322"
 SQL_FILE = "sqldb.db"
+COLUMN_DIR = "sqldb.columns"
 XLSX_PATH = "resources.xlsx"
 TABLE_NAME = "Resources"
 TARGET_FOOD = 40
 TARGET_WORKERS = 40
 TARGET_PRODUCTS = 50
+TIME_LIMIT = 70
+TRACE = False  # Logs every token movement at DEBUG, see configure_logging
+ENGINE_THREADS = "threads"
+ENGINE_EVENTS = "events"
+ENGINE_ASYNC = "async"
+FIRE_TIME = 0.05
+RETRY_TIME = 0.05
+CLOSED_TIME = 0.5
+WAIT_TIMEOUT = 0.5
+STABILIZE_INTERVAL = 0.2
+REARRANGE_LIMIT = 1
+REARRANGE_STEP = 10
+LATENCY_BUCKETS = 24
+STATS_TOP = 3
+EVENT_FIRE = "fire"
+EVENT_PRIORITY = "priority"
+EVENT_CONNECT = "connect"
+
+
+def _resolve(future: asyncio.Future):
+    """Wakes whoever awaits the future, unless already woken"""
+    if not future.done():
+        future.set_result(None)
+
+
+async def _await_with_timeout(future: asyncio.Future, timeout: float):
+    """Awaits a future that is resolved after the timeout at the latest"""
+    handle = asyncio.get_running_loop().call_later(timeout, _resolve, future)
+    try:
+        await future
+    finally:
+        handle.cancel()
 
 
 class GUIObject:
     """Graphics object class"""
+    __slots__ = ("_gui",)
+
     def __init__(self, gui: GuiComp):
         self._gui = gui
 
@@ -30,21 +73,33 @@ class GUIObject:
 
 
 class Resource(GUIObject):
-    """Resource/token class"""
+    """Resource/token class. Tokens use __slots__ to stay small,
+    see bench.bench_token_memory"""
+    __slots__ = ()
+
     def __init__(self, gui: GuiComp):
         """Resource Constructor"""
         super().__init__(gui)
 
+    def reset(self):
+        """Resets a recycled token to the state of a new one"""
+
     def __str__(self) -> str:
         return f"{self.__class__.__name__} [{hex(id(self))}]"
 
 
 class Worker(Resource):
     """Class representing a worker resource"""
+    __slots__ = ("_vitality",)
+
     def __init__(self, gui: GuiComp):
         super().__init__(gui)
         self._vitality = 100
 
+    def reset(self):
+        """Resets a recycled worker to full vitality"""
+        self._vitality = 100
+
     @property
     def vitality(self) -> int:
         """Returns the worker's vitality"""
@@ -65,10 +120,16 @@ class Worker(Resource):
 
 class Food(Resource):
     """Class representing a Food resource"""
+    __slots__ = ("_quality",)
+
     def __init__(self, quality: float, gui: GuiComp):
         super().__init__(gui)
         self._quality = quality
 
+    def reset(self, quality: float):
+        """Resets a recycled food with a new quality"""
+        self._quality = quality
+
     def get_quality(self) -> float:
         """Returns the quality of the food"""
         return self._quality
@@ -76,59 +137,295 @@ class Food(Resource):
 
 class Product(Resource):
     """Class representing a Product resource"""
+    __slots__ = ()
+
     def __init__(self, gui: GuiComp):
         super().__init__(gui)
 
 
+class TokenPool:
+    """Recycles consumed tokens of one type together with their GUI,
+    so that steady-state firing creates no new tokens"""
+    def __init__(self, create: Callable[..., Resource],
+                 enabled: bool = True):
+        self._create = create
+        self._enabled = enabled
+        self._free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, *args) -> Resource:
+        """Returns a recycled token reset with the arguments,
+        or a new token if there is none"""
+        try:
+            token = self._free.pop()
+        except IndexError:
+            self.created += 1
+            return self._create(*args)
+        self.reused += 1
+        token.reset(*args)
+        return token
+
+    def release(self, token: Resource):
+        """Returns a consumed token to the pool"""
+        if self._enabled:
+            self._free.append(token)
+
+
+def create_pools(sim_gui: SimSimsGUI,
+                 enabled: bool = True) -> dict[type, TokenPool]:
+    """Creates a token pool for workers, food and products"""
+    return {
+        Worker: TokenPool(lambda: Worker(sim_gui.create_token_gui(
+            {"color": COLOR_WORKER})), enabled),
+        Food: TokenPool(lambda quality: Food(quality, sim_gui.create_token_gui(
+            {"color": COLOR_FOOD})), enabled),
+        Product: TokenPool(lambda: Product(sim_gui.create_token_gui(
+            {"color": COLOR_PRODUCT})), enabled)}
+
+
+class ResourceCounter:
+    """Running total of the resources in a group of places"""
+    def __init__(self):
+        self._count = 0
+        self._lock = Lock()
+
+    @property
+    def count(self) -> int:
+        """Returns the current total"""
+        return self._count
+
+    def change(self, amount: int):
+        """Adds an amount to the total"""
+        with self._lock:
+            self._count += amount
+
+
+class IndexedHeap:
+    """Binary min-heap where the key of any item can be changed
+    in O(log n), the positions of the items are kept in a dict"""
+    def __init__(self):
+        self._heap = []
+        self._position = {}
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def top(self):
+        """Returns the item with the smallest key, None if empty"""
+        return self._heap[0][1] if self._heap else None
+
+    def push(self, item, key):
+        """Adds an item with a key"""
+        self._heap.append((key, item))
+        self._position[item] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def update(self, item, key):
+        """Changes the key of an item"""
+        i = self._position[item]
+        old_key = self._heap[i][0]
+        self._heap[i] = (key, item)
+        if key < old_key:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def _swap(self, i: int, j: int):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._position[self._heap[i][1]] = i
+        self._position[self._heap[j][1]] = j
+
+    def _sift_up(self, i: int):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._heap[i][0] >= self._heap[parent][0]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i: int):
+        size = len(self._heap)
+        while True:
+            smallest = i
+            for child in (2*i + 1, 2*i + 2):
+                if (child < size
+                        and self._heap[child][0] < self._heap[smallest][0]):
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+
+class PlaceHeap:
+    """Two-ended index of a group of places by number of resources.
+    The places update it on every add and get, ties are broken
+    by creation order"""
+    def __init__(self, places: list["Place"]):
+        self._emptiest = IndexedHeap()
+        self._fullest = IndexedHeap()
+        self._lock = Lock()
+        for place in places:
+            self._emptiest.push(place, (len(place), place._lock_order))
+            self._fullest.push(place, (-len(place), place._lock_order))
+            place.set_heap(self)
+
+    def changed(self, place: "Place"):
+        """Moves a place to match its current number of resources"""
+        with self._lock:
+            size = len(place)
+            self._emptiest.update(place, (size, place._lock_order))
+            self._fullest.update(place, (-size, place._lock_order))
+
+    def emptiest(self) -> "Place":
+        """Returns the place with the fewest resources"""
+        return self._emptiest.top()
+
+    def fullest(self) -> "Place":
+        """Returns the place with the most resources"""
+        return self._fullest.top()
+
+
 class Place(GUIObject):
-    """Class representing a graphical object with storage capabilities"""
-    def __init__(self, gui: GuiComp):
+    """Class representing a graphical object with storage capabilities.
+    Every add and get is also counted by the place's counter and
+    updates the place's heap, if given"""
+    _places_created = itertools.count()
+
+    def __init__(self, gui: GuiComp, counter: ResourceCounter = None):
         super().__init__(gui)
+        self._counter = counter
         self._resources = deque()
         self._reserved = 0
         self._lock = Lock()
-
-    def reserve(self) -> bool:
-        """Returns False if empty, otherwise returns True
-        and saves a resource to retrieve later"""
-        reservation_success = False
-        self._lock.acquire()
+        self._available = Condition(self._lock)
+        self._lock_order = next(Place._places_created)
+        self._heap = None
+        self._async_waiters = {}
+
+    def set_heap(self, heap: PlaceHeap):
+        """Sets the heap that is told when the number of resources changes"""
+        self._heap = heap
+
+    def _has_unreserved(self) -> bool:
+        return len(self._resources) - self._reserved > 0
+
+    def wait_for_token(self, timeout: float) -> bool:
+        """Blocks until a resource can be reserved or the timeout expires,
+        returns False on timeout"""
+        with self._available:
+            return self._available.wait_for(self._has_unreserved, timeout)
+
+    async def wait_for_token_async(self, timeout: float):
+        """Awaits until a resource can be reserved or the timeout expires.
+        Only for the asyncio engine, where every place is used
+        from the event loop's thread"""
+        if self._has_unreserved():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._async_waiters[future] = None
         try:
-            if len(self._resources) - self._reserved > 0:
-                self._reserved += 1
-                reservation_success = True
-                logging.debug("%s Reservation successful", self)
-            else:
-                logging.debug("%s Reservation unsuccessful", self)
+            await _await_with_timeout(future, timeout)
         finally:
-            self._lock.release()
-
+            self._async_waiters.pop(future, None)
+
+    def _wake_async(self):
+        """Wakes every coroutine waiting for a resource. A woken waiter
+        may go on to wait for another place instead, so waking only
+        some could leave the resource untaken until a timeout"""
+        for future in self._async_waiters:
+            if not future.done():
+                future.set_result(None)
+        self._async_waiters.clear()
+
+    @staticmethod
+    def reserve_all(requests: dict["Place", int]) -> "Place":
+        """Reserves a number of resources from each place in one atomic
+        step. Locks are taken in creation order to avoid deadlocks.
+        Returns None on success, otherwise the first place that
+        could not supply its resources, in which case nothing is reserved"""
+        places = sorted(requests, key=lambda p: p._lock_order)
+        for place in places:
+            place._lock.acquire()
+        try:
+            for place in places:
+                if len(place._resources) - place._reserved < requests[place]:
+                    if TRACE:
+                        logging.debug("%s Reservation unsuccessful", place)
+                    return place
+            for place in places:
+                place._reserved += requests[place]
+            return None
+        finally:
+            for place in reversed(places):
+                place._lock.release()
+
+    def reserve(self, count: int = 1) -> bool:
+        """Returns False if there are less than count unreserved resources,
+        otherwise returns True and saves them to retrieve later"""
+        with self._lock:
+            reservation_success = (len(self._resources) - self._reserved
+                                   >= count)
+            if reservation_success:
+                self._reserved += count
+        if TRACE:
+            logging.debug("%s Reservation %s", self, "successful"
+                          if reservation_success else "unsuccessful")
         return reservation_success
 
-    def unreserve(self):
-        """Removes a reservation"""
-        logging.debug("%s unreserve", self)
-        if self._reserved > 0:
-            self._reserved -= 1
-
-    def add(self, resource: Resource):
-        """Add a resource to the last place"""
-        self._resources.append(resource)
+    def unreserve(self, count: int = 1):
+        """Removes reservations"""
+        if TRACE:
+            logging.debug("%s unreserve", self)
+        with self._available:
+            count = min(count, self._reserved)
+            self._reserved -= count
+            self._available.notify_all()
+            self._wake_async()
+
+    def add(self, resource: Resource) -> bool:
+        """Add a resource to the last place, returns True if added"""
+        with self._available:
+            self._resources.append(resource)
+            self._available.notify_all()
+            self._wake_async()
+        if self._counter is not None:
+            self._counter.change(1)
+        if self._heap is not None:
+            self._heap.changed(self)
         self._gui.add_token(resource.get_gui())
-        logging.debug("%s, one %s added", self, resource)
+        if TRACE:
+            logging.debug("%s, one %s added", self, resource)
+        return True
+
+    def _take(self) -> Resource:
+        """Removes the next resource, the lock must be held"""
+        return self._resources.popleft()
 
     def get(self) -> Resource:
-        """Returns the oldest Resource, returns None if empty"""
-        if len(self._resources) > 0:
-            logging.debug("%s sends one resource", self)
-            resource = self._resources.popleft()
-            self._gui.remove_token(resource.get_gui())
-            logging.debug("%s has removed token")
-            self.unreserve()
-            logging.debug("%s has unreserved")
-
-            return resource
-        logging.debug("%s is empty, returns None", self)
+        """Returns the next Resource and removes its reservation,
+        returns None if empty"""
+        with self._lock:
+            if len(self._resources) == 0:
+                resource = None
+            else:
+                resource = self._take()
+                if self._reserved > 0:
+                    self._reserved -= 1
+
+        if resource is None:
+            if TRACE:
+                logging.debug("%s is empty, returns None", self)
+            return None
+        if self._counter is not None:
+            self._counter.change(-1)
+        if self._heap is not None:
+            self._heap.changed(self)
+        if TRACE:
+            logging.debug("%s sends %s", self, resource)
+        self._gui.remove_token(resource.get_gui())
+        return resource
 
     def __len__(self) -> int:
         return len(self._resources)
@@ -140,56 +437,220 @@ class Place(GUIObject):
 
 class Barn(Place):
     """Class representing a Barn place"""
-    def __init__(self, gui: GuiComp):
-        super().__init__(gui)
+    def __init__(self, gui: GuiComp, counter: ResourceCounter = None):
+        super().__init__(gui, counter)
 
 
 class Storage(Place):
     """Class representing a Storage place with a stack"""
-    def __init__(self, gui: GuiComp):
-        super().__init__(gui)
+    def __init__(self, gui: GuiComp, counter: ResourceCounter = None):
+        super().__init__(gui, counter)
 
-    def get(self) -> Product:
-        """Returns a product"""
-        if len(self._resources) > 0:
-            logging.debug("%s sends one product", self)
-            resource = self._resources.pop()
-            self._gui.remove_token(resource.get_gui())
-            self.unreserve()
-            return resource
-        logging.debug("%s is empty, returns None", self)
+    def _take(self) -> Product:
+        """Removes the newest product, the lock must be held"""
+        return self._resources.pop()
 
 
 class Barrack(Place):
     """Class for storing Workers in a queue"""
-    def __init__(self, gui: GuiComp):
-        super().__init__(gui)
+    def __init__(self, gui: GuiComp, counter: ResourceCounter = None):
+        super().__init__(gui, counter)
 
-    def add(self, worker: Worker):
-        """Add a worker to the barrack"""
+    def add(self, worker: Worker) -> bool:
+        """Add a worker to the barrack, returns False if it is dead"""
         if worker.vitality > 0:
-            self._resources.append(worker)
-            self._gui.add_token(worker.get_gui())
-            logging.debug("%s, %s returned", self, worker)
-        else:
+            return super().add(worker)
+        if TRACE:
             logging.debug("%s, %s dead", self, worker)
+        return False
 
     def __str__(self) -> str:
         result = f"{self.__class__.__name__}[{len(self._resources)}, {self._reserved}, {hex(id(self))}]"
         return result
 
 
+class EventLog:
+    """Records the firing order of a simulation so it can be replayed.
+    Firings and stabilizer changes are serialized by the log's lock"""
+    def __init__(self, events: list = None):
+        self.lock = Lock()
+        self._events = events if events is not None else []
+
+    def record(self, *event):
+        """Adds an event, the lock must be held"""
+        self._events.append(event)
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def save(self, path: str):
+        """Saves the events to a json file"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self._events, file)
+
+    @classmethod
+    def load(cls, path: str) -> "EventLog":
+        """Loads events from a json file"""
+        with open(path, encoding="utf-8") as file:
+            return cls([tuple(event) for event in json.load(file)])
+
+
+class TransitionStats:
+    """Counters of one transition: firings, failed reservations, seconds
+    spent closed and a histogram of firing latency, where bucket i counts
+    the firings that took less than 2**i microseconds"""
+    def __init__(self):
+        self.firings = 0
+        self.failed = 0
+        self._closed_time = 0.0
+        self._closed_since = None
+        self.latency = [0] * LATENCY_BUCKETS
+
+    def fired(self, seconds: float):
+        """Counts one firing that took a number of seconds"""
+        self.firings += 1
+        bucket = (int)(seconds*1e6).bit_length()
+        self.latency[min(bucket, LATENCY_BUCKETS-1)] += 1
+
+    def closed(self):
+        """Starts counting time spent closed"""
+        self._closed_since = time.perf_counter()
+
+    def opened(self):
+        """Stops counting time spent closed"""
+        if self._closed_since is not None:
+            self._closed_time += time.perf_counter() - self._closed_since
+            self._closed_since = None
+
+    @property
+    def closed_time(self) -> float:
+        """Returns the seconds spent closed, including the current
+        closed period"""
+        if self._closed_since is None:
+            return self._closed_time
+        return self._closed_time + time.perf_counter() - self._closed_since
+
+    def percentile(self, fraction: float) -> int:
+        """Returns the upper bound in microseconds of the latency bucket
+        holding the given fraction of firings, 0 if none fired"""
+        if self.firings == 0:
+            return 0
+        seen = 0
+        for bucket, count in enumerate(self.latency):
+            seen += count
+            if seen >= fraction*self.firings:
+                return 2**bucket
+        return 2**(LATENCY_BUCKETS-1)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of the counters"""
+        return {"firings": self.firings, "failed": self.failed,
+                "closed_time": self.closed_time,
+                "latency": list(self.latency),
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99)}
+
+
 class Transition(Thread, GUIObject):
     """Class that represents transitions"""
     def __init__(self, barrack_in: Barrack, barrack_out: Barrack,
-                 gui: GuiComp, sim_gui: SimSimsGUI):
+                 gui: GuiComp, sim_gui: SimSimsGUI, rng: Random = None):
         Thread.__init__(self)
         GUIObject.__init__(self, gui)
         self.barrack_in = barrack_in
         self.barrack_out = barrack_out
         self._gui = gui
         self._sim_gui = sim_gui
+        self._rng = rng if rng is not None else Random()
+        self._log = None
+        self._registry = None
+        self._pools = None
+        self.index = 0
         self._closed = False
+        self._opened = Event()
+        self._opened.set()
+        self._open_waiter = None
+        self._starved_on = None
+        self._stats = TransitionStats()
+
+    @property
+    def firings(self) -> int:
+        """Returns the number of times the transition has fired"""
+        return self._stats.firings
+
+    @property
+    def stats(self) -> TransitionStats:
+        """Returns the transition's counters"""
+        return self._stats
+
+    def fire(self) -> bool:
+        """Makes one firing attempt, returns True if the transition fired"""
+        raise NotImplementedError()
+
+    def record_to(self, log: EventLog):
+        """Records every firing to the log under the transition's index"""
+        self._log = log
+
+    def set_pools(self, pools: dict[type, TokenPool]):
+        """Sets the pools that new tokens are taken from
+        and consumed tokens are returned to"""
+        self._pools = pools
+
+    def set_registry(self, registry: "TransitionRegistry"):
+        """Sets the registry that is told when the transition is toggled"""
+        self._registry = registry
+
+    def _attempt(self) -> bool:
+        """Fires and counts the firing, recording it if there is a log"""
+        start = time.perf_counter()
+        if self._log is None:
+            fired = self.fire()
+        else:
+            with self._log.lock:
+                fired = self.fire()
+                if fired:
+                    self._log.record(EVENT_FIRE, self.index)
+        if fired:
+            self._stats.fired(time.perf_counter() - start)
+        return fired
+
+    def step(self) -> float:
+        """Makes one firing attempt for the event scheduler,
+        returns the simulated time until the next attempt"""
+        if self._closed:
+            return CLOSED_TIME
+        if self._attempt():
+            return FIRE_TIME
+        return RETRY_TIME
+
+    def run(self):
+        """Run method that repeats the firing process"""
+        while not self._stop_event.is_set():
+            if self._closed:
+                self._opened.wait(WAIT_TIMEOUT)
+                continue
+
+            if not self._attempt() and self._starved_on is not None:
+                self._starved_on.wait_for_token(WAIT_TIMEOUT)
+
+    async def run_async(self):
+        """Coroutine that repeats the firing process on an event loop"""
+        loop = asyncio.get_running_loop()
+        while not self._stop_event.is_set():
+            if self._closed:
+                self._open_waiter = loop.create_future()
+                await _await_with_timeout(self._open_waiter, WAIT_TIMEOUT)
+                self._open_waiter = None
+                continue
+
+            if self._attempt():
+                await asyncio.sleep(0)
+            elif self._starved_on is not None:
+                await self._starved_on.wait_for_token_async(WAIT_TIMEOUT)
+            else:
+                await asyncio.sleep(0)
 
     def is_closed(self) -> bool:
         """Returns True if transition is closed, otherwise False"""
@@ -198,112 +659,150 @@ class Transition(Thread, GUIObject):
     def toggle_closed(self):
         """Sets closed to the opposite value it currently has"""
         self._closed = not self._closed
+        if self._closed:
+            self._opened.clear()
+            self._stats.closed()
+        else:
+            self._opened.set()
+            self._stats.opened()
+            if self._open_waiter is not None:
+                _resolve(self._open_waiter)
+        if self._registry is not None:
+            self._registry.toggled(self)
 
     def __str__(self) -> str:
         return f"{self.__class__.__name__}[{hex(id(self))}]"
 
     def _retrieve(self, place: Place) -> Resource:
-        logging.debug("%s retrieving 1 from %s", self, place)
+        if TRACE:
+            logging.debug("%s retrieving 1 from %s", self, place)
         resource = place.get()
         if resource is not None:
             self._gui.add_token(resource.get_gui())
         return resource
 
     def _reserve(self, place: Place) -> bool:
-        logging.debug("%s attempts to reserve 1 from %s", self, place)
+        if TRACE:
+            logging.debug("%s attempts to reserve 1 from %s", self, place)
         reservation = place.reserve()
-        if not reservation:
-            logging.debug("%s empty: %s", self, self.barrack_in)
+        if reservation:
+            self._starved_on = None
+        else:
+            self._starved_on = place
+            self._stats.failed += 1
+            if TRACE:
+                logging.debug("%s empty: %s", self, place)
         return reservation
 
+    def _reserve_all(self, requests: dict[Place, int]) -> bool:
+        if TRACE:
+            logging.debug("%s attempts to reserve %s", self, requests)
+        self._starved_on = Place.reserve_all(requests)
+        if self._starved_on is not None:
+            self._stats.failed += 1
+            if TRACE:
+                logging.debug("%s empty: %s", self, self._starved_on)
+        return self._starved_on is None
+
     def _send_resource(self, resource: Resource, place: Place):
-        logging.debug("%s sent %s to %s", self, resource, place)
+        if TRACE:
+            logging.debug("%s sent %s to %s", self, resource, place)
         self._gui.remove_token(resource.get_gui())
-        place.add(resource)
+        if not place.add(resource):
+            self._release(resource)
+
+    def _acquire(self, token_type: Type[Resource], *args) -> Resource:
+        if self._pools is None:
+            self._pools = create_pools(self._sim_gui)
+        return self._pools[token_type].acquire(*args)
+
+    def _release(self, resource: Resource):
+        if self._pools is not None:
+            self._pools[type(resource)].release(resource)
 
 
 class Field(Transition):
     """Field class representing a field that produces food"""
     def __init__(self, barrack_in: Barrack, barrack_out: Barrack,
                  barn_out: Barn, stop_event: Event, gui: GuiComp,
-                 sim_gui: SimSimsGUI):
-        super().__init__(barrack_in, barrack_out, gui, sim_gui)
+                 sim_gui: SimSimsGUI, rng: Random = None):
+        super().__init__(barrack_in, barrack_out, gui, sim_gui, rng)
         self.barn_out = barn_out
         self._stop_event = stop_event
 
-    def run(self):
-        """Run method that creates food"""
-        while not self._stop_event.is_set():
-            if self._closed:
-                time.sleep(0.5)
-                continue
+    def fire(self) -> bool:
+        """Creates food from one worker"""
+        barrack_in = self.barrack_in
+        if not self._reserve(barrack_in):
+            return False
+        worker = self._retrieve(barrack_in)
 
-            if not self._reserve(self.barrack_in):
-                continue
-            worker = self._retrieve(self.barrack_in)
+        if worker is None:
+            return False
 
-            if worker is None:
-                continue
-
-            food = Food(random(), self._sim_gui.create_token_gui
-                        ({"color": COLOR_FOOD}))
-            self._gui.add_token(food.get_gui())
+        food = self._acquire(Food, self._rng.random())
+        self._gui.add_token(food.get_gui())
 
-            vitality_change = 0
-            if random() > 0.8:
-                vitality_change = -randrange(30, 80)
-            worker.change_vitality(vitality_change)
+        vitality_change = 0
+        if self._rng.random() > 0.8:
+            vitality_change = -self._rng.randrange(30, 80)
+        worker.change_vitality(vitality_change)
 
-            self._send_resource(worker, self.barrack_out)
-            self._send_resource(food, self.barn_out)
+        self._send_resource(worker, self.barrack_out)
+        self._send_resource(food, self.barn_out)
+        return True
 
 
 class DiningHall(Transition):
     """Dininghall transition where workers eat food"""
     def __init__(self, barrack_in: Barrack, barrack_out: Barrack,
                  barn_in: Barn, stop_event: Event, gui: GuiComp,
-                 sim_gui: SimSimsGUI):
-        super().__init__(barrack_in, barrack_out, gui, sim_gui)
+                 sim_gui: SimSimsGUI, rng: Random = None):
+        super().__init__(barrack_in, barrack_out, gui, sim_gui, rng)
         self.barn_in = barn_in
         self._stop_event = stop_event
 
-    def run(self):
-        """Run method that repeats the dining process"""
-        while not self._stop_event.is_set():
-            if self._closed:
-                time.sleep(0.5)
-                continue
-
-            if not self._reserve(self.barrack_in):
-                continue
+    def fire(self) -> bool:
+        """Feeds one worker with one food"""
+        barrack_in, barn_in = self.barrack_in, self.barn_in
+        if not self._reserve_all({barrack_in: 1, barn_in: 1}):
+            return False
 
-            if not self._reserve(self.barn_in):
-                self.barrack_in.unreserve()
-                continue
-
-            food = self._retrieve(self.barn_in)
-            worker = self._retrieve(self.barrack_in)
-            if worker is None:
-                continue
+        food = self._retrieve(barn_in)
+        worker = self._retrieve(barrack_in)
+        if worker is None:
+            return False
 
+        if TRACE:
             logging.debug("%s food %s, worker %s", self, food, worker)
 
-            vitality_change = (int)(math.atan(6*food.get_quality()-2)*25)
-            worker.change_vitality(vitality_change)
-            self._gui.remove_token(food.get_gui())
-            self._send_resource(worker, self.barrack_out)
+        vitality_change = (int)(math.atan(6*food.get_quality()-2)*25)
+        worker.change_vitality(vitality_change)
+        self._gui.remove_token(food.get_gui())
+        self._release(food)
+        self._send_resource(worker, self.barrack_out)
+        return True
 
 
 class Home(Transition):
     """Home Transition representing a resting area for workers"""
     def __init__(self, barrack_in: Barrack, barrack_out: Barrack,
                  storage_in: Storage, stop_event: Event, gui: GuiComp,
-                 sim_gui: SimSimsGUI):
-        super().__init__(barrack_in, barrack_out, gui, sim_gui)
+                 sim_gui: SimSimsGUI, rng: Random = None):
+        super().__init__(barrack_in, barrack_out, gui, sim_gui, rng)
         self.storage_in = storage_in
         self._stop_event = stop_event
         self._priority = 0.5
 
+    @property
+    def priority(self) -> float:
+        """Returns the home's priority to rest"""
+        return self._priority
+
+    @priority.setter
+    def priority(self, value: float):
+        self._priority = min(1, max(0, value))
+
     def change_priority(self, amount: float):
         """Change if home priorities to reproduce or rest
         Higher priority = smaller chance to reproduce
@@ -314,102 +813,197 @@ class Home(Transition):
         elif self._priority < 0:
             self._priority = 0
 
-    def run(self):
-        """Run method that repeats the resting process"""
-        while not self._stop_event.is_set():
-            if self._closed:
-                time.sleep(0.5)
-                continue
-
-            if not self._reserve(self.storage_in):
-                continue
-
-            if not self._reserve(self.barrack_in):
-                self.storage_in.unreserve()
-                continue
+    def fire(self) -> bool:
+        """Lets one worker rest or two workers reproduce"""
+        barrack_in, storage_in = self.barrack_in, self.storage_in
+        if not self._reserve_all({storage_in: 1, barrack_in: 1}):
+            return False
 
-            product = self._retrieve(self.storage_in)
+        product = self._retrieve(storage_in)
 
-            barrack_has_worker_2 = False
-            if random() > self._priority:
-                barrack_has_worker_2 = self.barrack_in.reserve()
+        barrack_has_worker_2 = False
+        if self._rng.random() > self._priority:
+            barrack_has_worker_2 = barrack_in.reserve()
 
-            if barrack_has_worker_2:
-                worker_1 = self._retrieve(self.barrack_in)
-                worker_2 = self._retrieve(self.barrack_in)
+        if barrack_has_worker_2:
+            worker_1 = self._retrieve(barrack_in)
+            worker_2 = self._retrieve(barrack_in)
 
-                if worker_1 is None:
-                    self._send_resource(worker_2, self.barrack_out)
-                    continue
-                if worker_2 is None:
-                    self._send_resource(worker_1, self.barrack_out)
-                    continue
+            if worker_1 is None:
+                self._send_resource(worker_2, self.barrack_out)
+                return False
+            if worker_2 is None:
+                self._send_resource(worker_1, self.barrack_out)
+                return False
 
-                worker_3 = Worker(self._sim_gui.create_token_gui
-                                  ({"color": COLOR_WORKER}))
-                self._gui.add_token(worker_3.get_gui())
+            worker_3 = self._acquire(Worker)
+            self._gui.add_token(worker_3.get_gui())
+            if TRACE:
                 logging.debug("%s: new %s + %s -> %s", self,
                               worker_1, worker_2, worker_3)
 
-                self._send_resource(worker_1, self.barrack_out)
-                self._send_resource(worker_2, self.barrack_out)
+            self._send_resource(worker_1, self.barrack_out)
+            self._send_resource(worker_2, self.barrack_out)
 
-                self.barrack_out.add(worker_3)
-                self._gui.remove_token(worker_3.get_gui())
-            else:
-                worker_1 = self._retrieve(self.barrack_in)
-                if worker_1 is None:
-                    continue
+            self._send_resource(worker_3, self.barrack_out)
+        else:
+            worker_1 = self._retrieve(barrack_in)
+            if worker_1 is None:
+                return False
 
-                vitality_change = randrange(10, 35)
-                worker_1.change_vitality(vitality_change)
+            vitality_change = self._rng.randrange(10, 35)
+            worker_1.change_vitality(vitality_change)
+            if TRACE:
                 logging.debug("%s: Resting %s, plus %s", self,
                               worker_1, vitality_change)
-                self._send_resource(worker_1, self.barrack_out)
-            self._gui.remove_token(product.get_gui())
+            self._send_resource(worker_1, self.barrack_out)
+        self._gui.remove_token(product.get_gui())
+        self._release(product)
+        return True
 
 
 class Factory(Transition):
     """A Factory that produces products"""
     def __init__(self, barrack_in: Barrack, barrack_out: Barrack,
                  storage_out: Storage, stop_event: Event,
-                 gui: GuiComp, sim_gui: SimSimsGUI):
-        super().__init__(barrack_in, barrack_out, gui, sim_gui)
+                 gui: GuiComp, sim_gui: SimSimsGUI, rng: Random = None):
+        super().__init__(barrack_in, barrack_out, gui, sim_gui, rng)
         self.storage_out = storage_out
-        self._harm_level = randrange(0, 10)
+        self._harm_level = self._rng.randrange(0, 10)
         self._stop_event = stop_event
 
-    def run(self):
-        """Run method that repeats the manufacturing process"""
-        while not self._stop_event.is_set():
-            if self._closed:
-                time.sleep(0.5)
-                continue
+    def fire(self) -> bool:
+        """Manufactures one product with one worker"""
+        barrack_in = self.barrack_in
+        if not self._reserve(barrack_in):
+            return False
+
+        worker = self._retrieve(barrack_in)
+        if worker is None:
+            return False
+
+        product = self._acquire(Product)
+        self._gui.add_token(product.get_gui())
+
+        vitality_change = (int)(-40*(self._rng.random()**2)
+                                - self._harm_level)
+        worker.change_vitality(vitality_change)
+
+        self._send_resource(worker, self.barrack_out)
+        self._send_resource(product, self.storage_out)
+        return True
+
+
+class TransitionRegistry:
+    """Open and closed transitions indexed by type. Dicts are used as
+    ordered sets so that picking a transition is deterministic"""
+    def __init__(self):
+        self._all = {}
+        self._open = {}
+        self._closed = {}
+
+    def add(self, transition: Transition):
+        """Adds a transition and starts tracking its toggles"""
+        t_type = type(transition)
+        self._all.setdefault(t_type, []).append(transition)
+        self._open.setdefault(t_type, {})
+        self._closed.setdefault(t_type, {})
+        if transition.is_closed():
+            self._closed[t_type][transition] = None
+        else:
+            self._open[t_type][transition] = None
+        transition.set_registry(self)
+
+    def toggled(self, transition: Transition):
+        """Moves a transition between the open and closed sets"""
+        t_type = type(transition)
+        if transition.is_closed():
+            self._open[t_type].pop(transition, None)
+            self._closed[t_type][transition] = None
+        else:
+            self._closed[t_type].pop(transition, None)
+            self._open[t_type][transition] = None
 
-            if not self._reserve(self.barrack_in):
-                continue
+    def of_type(self, t_type: Type[Transition]) -> list[Transition]:
+        """Returns every transition of a type in the order they were added"""
+        return self._all.get(t_type, [])
 
-            worker = self._retrieve(self.barrack_in)
-            if worker is None:
-                continue
+    def closed_count(self, t_type: Type[Transition]) -> int:
+        """Returns the number of closed transitions of a type"""
+        return len(self._closed.get(t_type, {}))
+
+    def first(self, t_type: Type[Transition], closed: bool) -> Transition:
+        """Returns the transition of a type that has been open, or closed,
+        the longest. Returns None if there is none"""
+        transitions = (self._closed if closed else self._open).get(t_type, {})
+        return next(iter(transitions), None)
 
-            product = Product(self._sim_gui.create_token_gui
-                              ({"color": COLOR_PRODUCT}))
-            self._gui.add_token(product.get_gui())
 
-            vitality_change = (int)(-40*(random()**2) - self._harm_level)
-            worker.change_vitality(vitality_change)
+class Scheduler:
+    """Single-threaded discrete-event scheduler. Events are kept in a
+    priority queue keyed on simulated time"""
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._now = 0.0
 
-            self._send_resource(worker, self.barrack_out)
-            self._send_resource(product, self.storage_out)
+    @property
+    def now(self) -> float:
+        """Returns the current simulated time"""
+        return self._now
+
+    def schedule(self, delay: float, action: Callable[[], float]):
+        """Schedules an action to run after a simulated delay.
+        The action returns the delay until it runs again, or None"""
+        heapq.heappush(self._queue,
+                       (self._now + delay, next(self._counter), action))
+
+    def run(self, until: float, stop_event: Event):
+        """Runs events in time order until the time limit is reached,
+        the queue is empty or the stop event is set"""
+        while self._queue and not stop_event.is_set():
+            event_time, _, action = heapq.heappop(self._queue)
+            if event_time > until:
+                break
+            self._now = event_time
+            delay = action()
+            if delay is not None:
+                self.schedule(delay, action)
 
 
 class World:
     """Main class responsible for the entire simulation process"""
     def __init__(self, barrack_size: int, storage_size: int, barn_size: int,
                  dining_halls_size: int, homes_size: int, fields_size: int,
-                 factories_size: int, workers_size: int):
+                 factories_size: int, workers_size: int,
+                 engine: str = ENGINE_THREADS,
+                 target_food: int = TARGET_FOOD,
+                 target_workers: int = TARGET_WORKERS,
+                 target_products: int = TARGET_PRODUCTS,
+                 sql_file: str = SQL_FILE, xlsx_path: str = XLSX_PATH,
+                 headless: bool = False, seed: int = None,
+                 record: bool = False,
+                 rearrange_limit: int = REARRANGE_LIMIT,
+                 pooling: bool = True, time_limit: float = TIME_LIMIT,
+                 stats_interval: float = None, columnar: bool = False,
+                 column_dir: str = COLUMN_DIR):
         self.stop = False
+        self.firings_per_second = 0.0
+        if engine not in (ENGINE_THREADS, ENGINE_EVENTS, ENGINE_ASYNC):
+            raise ValueError(f"Unknown engine {engine}")
+        self._engine = engine
+        self._target_food = target_food
+        self._target_workers = target_workers
+        self._target_products = target_products
+        self._sql_file = sql_file
+        self._columnar = columnar
+        self._column_dir = column_dir
+        self._xlsx_path = xlsx_path
+        self._rng = Random(seed)
+        self._log = EventLog() if record else None
+        self._rearrange_limit = rearrange_limit
+        self._time_limit = time_limit
+        self._stats_interval = stats_interval
         if barrack_size < 1 or storage_size < 1 or barn_size < 1:
             self.stop = True
             return
@@ -419,20 +1013,34 @@ class World:
         self._dining_halls_count = dining_halls_size
         self._factories_count = factories_size
 
-        self._gui = SimSimsGUI(1000, 600)
+        self._headless = headless
+        if headless:
+            self._gui = NullGUI()
+        else:
+            self._gui = SimSimsGUI(1000, 600)
         self._stop_event = Event()
 
         self._day = 0
+        self._workers = ResourceCounter()
+        self._products = ResourceCounter()
+        self._food = ResourceCounter()
         self._barracks = [Barrack(self._gui.create_place_gui(
-            {"lable": "Barrack"}))for _ in range(barrack_size)]
+            {"lable": "Barrack"}), self._workers)
+            for _ in range(barrack_size)]
         self._storage = [Storage(self._gui.create_place_gui(
-            {"lable": "Storage"})) for _ in range(storage_size)]
+            {"lable": "Storage"}), self._products)
+            for _ in range(storage_size)]
         self._barns = [Barn(self._gui.create_place_gui(
-            {"lable": "Barn"})) for _ in range(barn_size)]
+            {"lable": "Barn"}), self._food) for _ in range(barn_size)]
+        self._barrack_heap = PlaceHeap(self._barracks)
+        self._storage_heap = PlaceHeap(self._storage)
+        self._barn_heap = PlaceHeap(self._barns)
         logging.info("Added barracks (%s), storages (%s), barns (%s)",
                      barrack_size, storage_size, barn_size)
 
+        self._pools = create_pools(self._gui, pooling)
         self._transitions = []
+        self._registry = TransitionRegistry()
         self._connect_transition(DiningHall, self._barns,
                                  dining_halls_size, "Dining Hall")
         self._connect_transition(Home, self._storage,
@@ -443,12 +1051,64 @@ class World:
                                  factories_size, "Factory")
 
         for _ in range(workers_size):
-            self._barracks[randrange(len(self._barracks))].add(
-                Worker(self._gui.create_token_gui({"color": COLOR_WORKER})))
+            self._rng.choice(self._barracks).add(
+                self._pools[Worker].acquire())
+
+        if self._log is not None:
+            for t in self._transitions:
+                t.record_to(self._log)
         self._init_gui()
 
+    def pool_stats(self) -> dict[str, tuple[int, int]]:
+        """Returns the number of created and reused tokens per type"""
+        return {token_type.__name__: (pool.created, pool.reused)
+                for token_type, pool in self._pools.items()}
+
+    def stats(self) -> list[dict]:
+        """Returns a snapshot of every transition's counters,
+        ordered by transition index"""
+        return [{"transition": t.__class__.__name__, "index": t.index,
+                 **t.stats.snapshot()} for t in self._transitions]
+
+    def _dump_stats(self):
+        """Logs a summary of the counters per transition type and the
+        STATS_TOP most starved transitions, see stats for all of them"""
+        snapshot = self.stats()
+        by_type = {}
+        for stats in snapshot:
+            by_type.setdefault(stats["transition"], []).append(stats)
+        for name, type_stats in by_type.items():
+            slowest = max(type_stats, key=lambda stats: stats["p99"])
+            starved = max(type_stats, key=lambda stats: stats["failed"])
+            logging.info("%s x%s: %s fired, %s failed, %.2f s closed, "
+                         "worst p99 %s us (%s), most failed %s (%s)",
+                         name, len(type_stats),
+                         sum(stats["firings"] for stats in type_stats),
+                         sum(stats["failed"] for stats in type_stats),
+                         sum(stats["closed_time"] for stats in type_stats),
+                         slowest["p99"], slowest["index"],
+                         starved["failed"], starved["index"])
+        starved = sorted(snapshot, key=lambda stats: stats["failed"],
+                         reverse=True)[:STATS_TOP]
+        logging.info("Most starved: %s", ", ".join(
+            f"{stats['transition']} {stats['index']} ({stats['failed']})"
+            for stats in starved))
+
+    def _stats_dumper(self):
+        """Logs the transitions' counters every stats interval"""
+        while not self._stop_event.wait(self._stats_interval):
+            self._dump_stats()
+
+    @property
+    def event_log(self) -> EventLog:
+        """Returns the recorded events, None if not recording"""
+        return self._log
+
     def _init_gui(self):
         """Initializes the UI elements"""
+        if self._headless:
+            return
+
         place_list = self._barns+self._barracks+self._storage
         transitions_len = len(self._transitions)
         places_len = len(place_list)
@@ -469,12 +1129,13 @@ class World:
                             size: int, label: str):
         """Creates transitions and connects them to places"""
         for _ in range(size):
-            barrack_1 = self._barracks[randrange(len(self._barracks))]
-            barrack_2 = self._barracks[randrange(len(self._barracks))]
-            place_other = place_others[randrange(len(place_others))]
+            barrack_1 = self._rng.choice(self._barracks)
+            barrack_2 = self._rng.choice(self._barracks_out())
+            place_other = self._rng.choice(place_others)
             transit = transition_type(
                 barrack_1, barrack_2, place_other, self._stop_event,
-                self._gui.create_transition_gui({"lable": label}), self._gui)
+                self._gui.create_transition_gui({"lable": label}), self._gui,
+                Random(self._rng.getrandbits(64)))
 
             if transition_type == DiningHall or transition_type == Home:
                 self._gui.connect(place_other.get_gui(),
@@ -487,20 +1148,26 @@ class World:
             self._gui.connect(transit.get_gui(), barrack_2.get_gui(),
                               {"arrows": True})
 
+            transit.index = len(self._transitions)
+            transit.set_pools(self._pools)
             self._transitions.append(transit)
+            self._registry.add(transit)
+
+    def _barracks_out(self) -> list[Barrack]:
+        """Returns the barracks new transitions can send workers to"""
+        return self._barracks
+
+    def _is_finished(self) -> bool:
+        """Returns True if there are no workers left"""
+        return self._workers.count == 0
 
     def _sim_finished(self):
         """Determines when the simulation is done"""
         start_time = time.time()
         while not self._stop_event.is_set():
-            stop_sim = True
-            b: Barrack
-            for b in self._barracks:
-                if len(b) > 0:
-                    stop_sim = False
-                    break
-
-            if time.time() - start_time > 70:
+            stop_sim = self._is_finished()
+
+            if time.time() - start_time > self._time_limit:
                 stop_sim = True
 
             if stop_sim:
@@ -508,134 +1175,228 @@ class World:
                 self._stop_event.set()
             time.sleep(0.05)
 
-    def _resource_count(self) -> tuple[int, int, int]:
-        """Counts the number of workers, products and food in the world"""
-        workers_count = 0
-        b: Barrack
-        for b in self._barracks:
-            workers_count += len(b)
-
-        product_count = 0
-        s: Storage
-        for s in self._storage:
-            product_count += len(s)
-
-        food_count = 0
-        b: Barn
-        for b in self._barns:
-            food_count += len(b)
+    def resource_count(self) -> tuple[int, int, int]:
+        """Returns the number of workers, products and food in the world"""
+        return (self._workers.count, self._products.count, self._food.count)
+
+    def analytics(self) -> Analytics:
+        """Opens the store the resource count is recorded to, a
+        ColumnStore in the column directory if columnar, otherwise
+        Analytics on the sql file"""
+        if self._columnar:
+            return ColumnStore(self._column_dir, TABLE_NAME)
+        return Analytics(self._sql_file, TABLE_NAME)
+
+    def _open_analytics(self) -> Analytics:
+        """Opens the store for the resource count and clears it"""
+        analytics = self.analytics()
+        analytics.create_table()
+        return analytics
 
-        return (workers_count, product_count, food_count)
+    def _record_step(self, analytics: Analytics, cur_time: int):
+        """Stores the current resource count in the database"""
+        workers_count, product_count, food_count = self.resource_count()
+        analytics.add_step(cur_time, workers_count,
+                           product_count, food_count)
 
     def _observer(self):
         """Logs resources and store them in a database and xlsx"""
         start_time = time.time()
-        analytics = Analytics(SQL_FILE, TABLE_NAME)
-        analytics.create_table()
+        analytics = self._open_analytics()
 
         while True:
-            workers_count, product_count, food_count = self._resource_count()
-
-            cur_time = (int)((time.time()-start_time)*1000)
-            analytics.add_step(cur_time, workers_count,
-                               product_count, food_count)
+            self._record_step(analytics,
+                              (int)((time.time()-start_time)*1000))
             if self._stop_event.is_set():
                 break
             time.sleep(0.1)
-        analytics.save_to_xlsx(XLSX_PATH)
-        logging.info("Saved to xlsx")
+        self._save(analytics)
+
+    def _save(self, analytics: Analytics):
+        """Saves the recorded steps to xlsx, if a path was given,
+        and closes the database"""
+        if self._xlsx_path is not None:
+            analytics.save_to_xlsx(self._xlsx_path, streaming=True)
+            logging.info("Saved to xlsx")
+        analytics.close()
 
     def _stabilizer(self):
         """Adjusts the transitions to that the resources are balanced"""
         while not self._stop_event.is_set():
-            workers_count, product_count, food_count = self._resource_count()
-            alter_home = 0
-            if workers_count > TARGET_WORKERS*1.2:
-                alter_home = 0.2
-            elif workers_count < TARGET_WORKERS*.8:
-                alter_home = -0.2
-
-            factory_closed = dining_hall_closed = 0
-            field_closed = home_closed = 0
+            with self._log.lock if self._log is not None else nullcontext():
+                self._stabilize()
+            time.sleep(STABILIZE_INTERVAL)
+
+    def _stabilize(self):
+        """Makes one adjustment of the transitions"""
+        workers_count, product_count, food_count = self.resource_count()
+        alter_home = 0
+        if workers_count > self._target_workers*1.2:
+            alter_home = 0.2
+        elif workers_count < self._target_workers*.8:
+            alter_home = -0.2
 
-            t: Transition
-            for t in self._transitions:
-                if isinstance(t, Home):
-                    t.change_priority(alter_home*random())
-                    if t.is_closed():
-                        home_closed += 1
-                if isinstance(t, Factory) and t.is_closed():
-                    factory_closed += 1
-                if isinstance(t, DiningHall) and t.is_closed():
-                    dining_hall_closed += 1
-                if isinstance(t, Field) and t.is_closed():
-                    field_closed += 1
-
-            self._stabilize_transition(self._home_count, workers_count,
-                                       TARGET_WORKERS, home_closed, Home)
-            self._stabilize_transition(self._dining_halls_count,
-                                       workers_count, TARGET_WORKERS,
-                                       dining_hall_closed, DiningHall)
-            self._stabilize_transition(self._fields_count, food_count,
-                                       TARGET_FOOD, field_closed, Field)
-            self._stabilize_transition(self._factories_count,
-                                       product_count, TARGET_PRODUCTS,
-                                       factory_closed, Factory)
-            self._rearrange_connections()
-            time.sleep(0.2)
+        t: Transition
+        for t in self._registry.of_type(Home):
+            t.change_priority(alter_home*self._rng.random())
+            if alter_home and self._log is not None:
+                self._log.record(EVENT_PRIORITY, t.index, t.priority)
+
+        self._stabilize_transition(self._home_count, workers_count,
+                                   self._target_workers, Home)
+        self._stabilize_transition(self._dining_halls_count,
+                                   workers_count, self._target_workers,
+                                   DiningHall)
+        self._stabilize_transition(self._fields_count, food_count,
+                                   self._target_food, Field)
+        self._stabilize_transition(self._factories_count,
+                                   product_count, self._target_products,
+                                   Factory)
+        self._rearrange_connections()
 
     def _stabilize_transition(self, tran_count: int,
                               resources_count: int, target_resources: int,
-                              closed_count: int, t_type: Type[Transition]):
+                              t_type: Type[Transition]):
         """Turns transitions off and on based on resource count"""
+        closed_count = self._registry.closed_count(t_type)
         closed_target = min(tran_count-1, max(0, (int)(
             tran_count*(resources_count-target_resources)/target_resources)))
 
         if not closed_target == closed_count:
-            t: Transition
-            for t in self._transitions:
-                if (isinstance(t, t_type)
-                        and t.is_closed() == (closed_count > closed_target)):
-                    t.toggle_closed()
-                    break
+            t = self._registry.first(t_type, closed_count > closed_target)
+            if t is not None:
+                t.toggle_closed()
+
+    def _other_places(self, t: Transition) -> list[Place]:
+        """Returns the places a transition picks its storage or barn from"""
+        if isinstance(t, (Home, Factory)):
+            return self._storage
+        return self._barns
+
+    def _other_heap(self, t: Transition) -> PlaceHeap:
+        """Returns the heap of the places a transition picks
+        its storage or barn from"""
+        if isinstance(t, (Home, Factory)):
+            return self._storage_heap
+        return self._barn_heap
 
     def _rearrange_connections(self):
-        """Rearrages transition connections for
-        more evenly distributed resources"""
-        t: Transition
-        t = self._transitions[randrange(len(self._transitions))]
+        """Rearrages transition connections for more evenly distributed
+        resources. Moves one transition per REARRANGE_STEP workers of
+        difference between the fullest and emptiest barrack, at least one
+        and at most the rearrange limit"""
+        barrack_in = self._barrack_heap.fullest()
+        barrack_out = self._barrack_heap.emptiest()
+        moves = max(1, min(self._rearrange_limit,
+                           (len(barrack_in)-len(barrack_out))//REARRANGE_STEP))
+
+        for _ in range(moves):
+            i = self._rng.randrange(len(self._transitions))
+            t: Transition = self._transitions[i]
+            if isinstance(t, (Home, DiningHall)):
+                place_other = self._other_heap(t).fullest()
+            else:
+                place_other = self._other_heap(t).emptiest()
+            self._reconnect(t, barrack_in, barrack_out, place_other)
+
+            if self._log is not None:
+                self._log.record(EVENT_CONNECT, i,
+                                 self._barracks.index(barrack_in),
+                                 self._barracks.index(barrack_out),
+                                 self._other_places(t).index(place_other))
+
+    def _reconnect(self, t: Transition, barrack_in: Barrack,
+                   barrack_out: Barrack, place_other: Place):
+        """Connects a transition to new places"""
         self._gui.disconnect(t.get_gui(), t.barrack_out.get_gui())
         self._gui.disconnect(t.barrack_in.get_gui(), t.get_gui())
-        t.barrack_in = max(self._barracks, key=len)
-        t.barrack_out = min(self._barracks, key=len)
+        t.barrack_in = barrack_in
+        t.barrack_out = barrack_out
         self._gui.connect(t.barrack_in.get_gui(), t.get_gui())
         self._gui.connect(t.get_gui(), t.barrack_out.get_gui())
 
         if isinstance(t, Home):
             self._gui.disconnect(t.storage_in.get_gui(), t.get_gui())
-            t.storage_in = max(self._storage, key=len)
+            t.storage_in = place_other
             self._gui.connect(t.storage_in.get_gui(), t.get_gui())
         elif isinstance(t, DiningHall):
             self._gui.disconnect(t.barn_in.get_gui(), t.get_gui())
-            t.barn_in = max(self._barns, key=len)
+            t.barn_in = place_other
             self._gui.connect(t.barn_in.get_gui(), t.get_gui())
         elif isinstance(t, Factory):
             self._gui.disconnect(t.get_gui(), t.storage_out.get_gui())
-            t.storage_out = min(self._storage, key=len)
+            t.storage_out = place_other
             self._gui.connect(t.get_gui(), t.storage_out.get_gui())
         elif isinstance(t, Field):
             self._gui.disconnect(t.get_gui(), t.barn_out.get_gui())
-            t.barn_out = min(self._barns, key=len)
+            t.barn_out = place_other
             self._gui.connect(t.get_gui(), t.barn_out.get_gui())
 
+    def replay(self, log: EventLog) -> float:
+        """Re-executes a recorded run on a world created with the same
+        arguments and seed, returns how many seconds it took"""
+        if self.stop:
+            return 0.0
+
+        firings = mismatches = 0
+        start_time = time.time()
+        for event in log:
+            if event[0] == EVENT_FIRE:
+                if self._transitions[event[1]].fire():
+                    firings += 1
+                else:
+                    mismatches += 1
+            elif event[0] == EVENT_PRIORITY:
+                self._transitions[event[1]].priority = event[2]
+            elif event[0] == EVENT_CONNECT:
+                t = self._transitions[event[1]]
+                self._reconnect(t, self._barracks[event[2]],
+                                self._barracks[event[3]],
+                                self._other_places(t)[event[4]])
+        elapsed = time.time() - start_time
+
+        if mismatches:
+            logging.warning("%s firings could not be replayed", mismatches)
+        if elapsed > 0:
+            self.firings_per_second = firings / elapsed
+        logging.info("Replayed %s events in %.3f s (%.0f firings/s)",
+                     len(log), elapsed, self.firings_per_second)
+        return elapsed
+
+    @property
+    def firings(self) -> int:
+        """Returns the number of times all transitions have fired"""
+        return sum(t.firings for t in self._transitions)
+
+    def _report_firings(self, elapsed: float):
+        """Logs the number of firings per second of wall time"""
+        firings = self.firings
+        if elapsed > 0:
+            self.firings_per_second = firings / elapsed
+        logging.info("%s firings in %.2f s (%.0f firings/s)",
+                     firings, elapsed, self.firings_per_second)
+
     def simulate(self):
         """Starts the world simulation"""
         if self.stop:  # If less than one barrack, barn and storage
             return
 
+        start_time = time.time()
+        if self._engine == ENGINE_EVENTS:
+            self._simulate_events()
+        elif self._engine == ENGINE_ASYNC:
+            asyncio.run(self._simulate_async())
+        else:
+            self._simulate_threads()
+        self._report_firings(time.time() - start_time)
+
+    def _simulate_threads(self):
+        """Runs every transition in its own thread"""
         threads = [Thread(target=self._sim_finished),
                    Thread(target=self._observer),
                    Thread(target=self._stabilizer)]
+        if self._stats_interval is not None:
+            threads.append(Thread(target=self._stats_dumper))
 
         t: Thread
         for t in threads:
@@ -645,30 +1406,141 @@ class World:
         for t in self._transitions:
             t.start()
 
-        self._gui.mainloop()
+        if self._headless:
+            self._stop_event.wait()
+        else:
+            self._gui.mainloop()
         self._stop_event.set()
         threads[1].join()
 
+    def _simulate_events(self):
+        """Runs every transition in a single thread with
+        a discrete-event scheduler on simulated time"""
+        scheduler = Scheduler()
+        analytics = self._open_analytics()
 
-def main():
-    """Main function"""
-    logging.basicConfig(filename='sim.log', level=logging.DEBUG,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
-                        filemode='w')
-    logging.info("Program started")
+        def observe() -> float:
+            self._record_step(analytics, (int)(scheduler.now*1000))
+            return 0.1
+
+        def stabilize() -> float:
+            self._stabilize()
+            return STABILIZE_INTERVAL
 
+        def finish() -> float:
+            if self._is_finished():
+                logging.info("Sim finished")
+                self._stop_event.set()
+            return 0.05
+
+        def redraw() -> float:
+            self._gui.update()
+            if not self._gui.is_alive:
+                self._stop_event.set()
+            return 0.05
+
+        def dump_stats() -> float:
+            self._dump_stats()
+            return self._stats_interval
+
+        t: Transition
+        for t in self._transitions:
+            scheduler.schedule(self._rng.random()*FIRE_TIME, t.step)
+        scheduler.schedule(0, observe)
+        scheduler.schedule(0, stabilize)
+        scheduler.schedule(0, finish)
+        if not self._headless:
+            scheduler.schedule(0, redraw)
+        if self._stats_interval is not None:
+            scheduler.schedule(self._stats_interval, dump_stats)
+
+        scheduler.run(self._time_limit, self._stop_event)
+        self._stop_event.set()
+        self._save(analytics)
+
+    async def _every(self, interval: float, action: Callable[[], None]):
+        """Coroutine that calls an action every interval until stopped"""
+        while not self._stop_event.is_set():
+            action()
+            await asyncio.sleep(interval)
+
+    async def _simulate_async(self):
+        """Runs every transition as a coroutine on one asyncio event loop"""
+        analytics = self._open_analytics()
+        start_time = time.time()
+
+        def observe():
+            self._record_step(analytics,
+                              (int)((time.time()-start_time)*1000))
+
+        def finish():
+            if (self._is_finished()
+                    or time.time()-start_time > self._time_limit):
+                logging.info("Sim finished")
+                self._stop_event.set()
+
+        def redraw():
+            self._gui.update()
+            if not self._gui.is_alive:
+                self._stop_event.set()
+
+        coroutines = [t.run_async() for t in self._transitions]
+        coroutines += [self._every(0.1, observe),
+                       self._every(STABILIZE_INTERVAL, self._stabilize),
+                       self._every(0.05, finish)]
+        if not self._headless:
+            coroutines.append(self._every(0.05, redraw))
+        if self._stats_interval is not None:
+            coroutines.append(self._every(self._stats_interval,
+                                          self._dump_stats))
+        await asyncio.gather(*coroutines)
+        self._save(analytics)
+
+
+def configure_logging(filename: str,
+                      level: int = logging.DEBUG) -> QueueListener:
+    """Logs to a file and INFO to the console through a queue, so that
+    transitions never wait on file I/O. Token movements are only traced
+    when the level is DEBUG. Returns the listener writing the records,
+    which must be stopped to flush them. Calling it again replaces the
+    queue handler of the earlier call, whose listener is left to stop"""
+    global TRACE
+    TRACE = level <= logging.DEBUG
+
+    file_handler = logging.FileHandler(filename, mode='w')
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(levelname)s - %(message)s'))
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
+
+    log_queue = queue.SimpleQueue()
     root_logger = logging.getLogger()
-    root_logger.addHandler(console_handler)
+    root_logger.setLevel(level)
+    for handler in root_logger.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, file_handler, console_handler,
+                             respect_handler_level=True)
+    listener.start()
+    return listener
 
-    w1 = World(3, 2, 2, 4, 5, 5, 5, 50)
-    w1.simulate()
-    logging.info("Program ended")
 
-    logging.info("Creating diagram")
-    analytics = Analytics(SQL_FILE, TABLE_NAME)
-    analytics.to_figure()
+def main():
+    """Main function"""
+    listener = configure_logging('sim.log')
+    try:
+        logging.info("Program started")
+
+        w1 = World(3, 2, 2, 4, 5, 5, 5, 50)
+        w1.simulate()
+        logging.info("Program ended")
+
+        logging.info("Creating diagram")
+        analytics = w1.analytics()
+        analytics.to_figure()
+    finally:
+        listener.stop()
 
 
 if __name__ == '__main__':
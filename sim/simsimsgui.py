@@ -1,7 +1,8 @@
 from collections import deque
-from copy import copy, deepcopy
+from copy import copy
 from math import cos, pi, sin, sqrt
 from threading import Lock, Thread
+from time import perf_counter
 from tkinter import BOTH, CENTER, LAST, Canvas, Tk, font
 
 ''' A graphical user iterface for a SimSims network '''
@@ -9,19 +10,27 @@ from tkinter import BOTH, CENTER, LAST, Canvas, Tk, font
 class Coords():
     ''' 
     Represent coordinate pairs.
+    The coordinates are kept in a tuple of floats, so copies and
+    translated coordinates can share or build it without conversion.
 
     Args:
         x1,y1,x2,y2,...: a sequence of coordinate pairs
     '''
+    __slots__ = ("_coords",)
 
     def __init__(self, *args, **kwargs):
-        self._coords = []
-        self.append(*args)
+        assert len(args) % 2 == 0
+        self._coords = tuple(map(float, args))
+
+    @classmethod
+    def _of(cls, coords):
+        ''' Creates coordinates from a tuple of floats. '''
+        nw = cls.__new__(cls)
+        nw._coords = coords
+        return nw
 
     def __copy__(self):
-        newone = type(self)()
-        newone._coords = deepcopy(self._coords)
-        return newone
+        return type(self)._of(self._coords)
 
     def __iter__(self):
         return self._coords.__iter__()
@@ -56,8 +65,7 @@ class Coords():
         '''
         nargs = len(args)
         assert nargs % 2 == 0
-        for i in range(0, nargs, 2):
-            self._coords.extend((float(args[i]), float(args[i+1])))
+        self._coords += tuple(map(float, args))
 
     def translate(self, *args):
         ''' Returns a copy of stored coordinates, translated with dx, dy.
@@ -66,48 +74,136 @@ class Coords():
         '''
         if len(args) == 1:
             assert isinstance(args[0], Coords)
-            dx, dy = args[0].x, args[0].y
+            dx, dy = args[0]._coords[0], args[0]._coords[1]
         elif len(args) == 2:
             dx, dy = args[0], args[1]
         else:
             raise ValueError("To many or wrong arguments")
 
-        nw = type(self)()
-        for i in range(0, len(self._coords), 2):
-            nw.append(self._coords[i]+dx, self._coords[i+1]+dy)
-        return nw
+        coords = self._coords
+        if len(coords) == 2:
+            return Coords._of((coords[0]+dx, coords[1]+dy))
+        return Coords._of(tuple(
+            c+dy if i % 2 else c+dx for i, c in enumerate(coords)))
+
+    @classmethod
+    def translate_all(cls, coords_list, dx, dy):
+        ''' Returns a list of coordinate pairs translated with dx, dy.
+            Args:
+                coords_list: list of coordinate pairs.
+                dx, dy: value by witch to translate coordinates.
+        '''
+        new = cls._of
+        return [new((c[0]+dx, c[1]+dy))
+                for c in [coords._coords for coords in coords_list]]
 
 
 class MTCanvas(Canvas):
     ''' A Canvas modified to have limited capability of multi 
         threaded functionality.
+        Components are queued from any thread and drawn by exec_draw.
+        The queue is swapped for an empty one before drawing, so a
+        thread queuing a component never waits for a frame. Coordinates
+        set while drawing are coalesced per item and sent to Tk once at
+        the end of the frame. Components not drawn within the frame
+        budget are left for the next frame.
 
         Args:
             master: Master TK-object.
             w: with of the drawing area.
             h: height of the drawing area.
+            frame_budget: seconds a frame may spend drawing components.
     '''
+    FRAME_BUDGET = 0.04
 
-    def __init__(self, master, w, h):
+    def __init__(self, master, w, h, frame_budget=FRAME_BUDGET):
         Canvas.__init__(self, master, width=w, height=h)
-        #self._queue = deque()
         self._queue = set()
+        self._back_queue = set()
         self._lock = Lock()
+        self._frame_coords = None
+        self._frame_budget = frame_budget
+        self._frames = 0
+        self._frame_time = 0.0
+        self._max_frame_time = 0.0
+        self._deferred = 0
+        self._first_frame = None
+
+    @property
+    def frame_metrics(self):
+        ''' Frames drawn, mean and max frame time in ms, frames per
+            second since the first frame and the number of components
+            deferred to a later frame. '''
+        elapsed = perf_counter() - self._first_frame if self._frames else 0
+        return {"frames": self._frames,
+                "mean_ms": 1000*self._frame_time/max(1, self._frames),
+                "max_ms": 1000*self._max_frame_time,
+                "fps": self._frames/elapsed if elapsed > 0 else 0.0,
+                "deferred": self._deferred}
 
     def draw_component(self, component):
-        self._lock.acquire()
-        self._queue.add(component)
-        self._lock.release()
+        with self._lock:
+            self._queue.add(component)
+
+    def coords(self, item, *args):
+        ''' Overrides Canvas.coords. While a frame is drawn, new
+            coordinates are kept until the end of the frame. '''
+        if self._frame_coords is None:
+            return Canvas.coords(self, item, *args)
+        if args:
+            self._frame_coords[item] = args
+            return None
+        pending = self._frame_coords.pop(item, None)
+        if pending is not None:
+            Canvas.coords(self, item, *pending)
+        return Canvas.coords(self, item)
+
+    def delete(self, *items):
+        ''' Overrides Canvas.delete, dropping coordinates kept for
+            the deleted items. '''
+        if self._frame_coords is not None:
+            for item in items:
+                self._frame_coords.pop(item, None)
+        Canvas.delete(self, *items)
+
+    def _draw(self, components, deadline):
+        ''' Updates components until the deadline, at least one, and
+            sends their coordinates to Tk. '''
+        self._frame_coords = {}
+        drawn = 0
+        for component in components:
+            if drawn and perf_counter() > deadline:
+                break
+            component.update()
+            drawn += 1
+        if drawn < len(components):
+            with self._lock:
+                self._queue.update(components[drawn:])
+            self._deferred += len(components) - drawn
+
+        frame_coords, self._frame_coords = self._frame_coords, None
+        for item, args in frame_coords.items():
+            Canvas.coords(self, item, *args)
+        self.update()
 
     def exec_draw(self):
         ''' Draws objects in the queue. '''
-        self._lock.acquire()
-        if len(self._queue) > 0:
-            for component in self._queue:
-                component.update()
-            self._queue.clear()
-            self.update()
-        self._lock.release()
+        start = perf_counter()
+        with self._lock:
+            queue, self._queue = self._queue, self._back_queue
+        components = list(queue)
+        queue.clear()
+        self._back_queue = queue
+
+        if components:
+            self._draw(components, start + self._frame_budget)
+
+        frame_time = perf_counter() - start
+        if self._frames == 0:
+            self._first_frame = start
+        self._frames += 1
+        self._frame_time += frame_time
+        self._max_frame_time = max(self._max_frame_time, frame_time)
 
 
 class SimSimsGUI(Tk):
@@ -121,6 +217,7 @@ class SimSimsGUI(Tk):
 
         self._is_alive = True
         self._uis = []
+        self._arc_index = {}
         self._on_close = None
         self._canvas = MTCanvas(self, w, h)
         self._canvas.pack()
@@ -178,19 +275,20 @@ class SimSimsGUI(Tk):
                 src_ui: src of an arc.
                 dst_ui: dst of an arc.
         '''
-        if [x for x in src_ui._arcs if x._out == dst_ui]:
+        if (src_ui, dst_ui) in self._arc_index:
             return
 
-        barcs = [x for x in dst_ui._arcs if x._out == src_ui]
-        if barcs:
-            barcs[0].bidirectional = True
+        barc = self._arc_index.get((dst_ui, src_ui))
+        if barc is not None:
+            barc.bidirectional = True
         else:
             a_ui = self._create_arc_gui(src_ui, dst_ui, properties)
             if a_ui:
                 a_ui._out = dst_ui
                 a_ui._in = src_ui
-                src_ui._arcs.append(a_ui)
-                dst_ui._arcs.append(a_ui)
+                self._arc_index[(src_ui, dst_ui)] = a_ui
+                src_ui._arcs[a_ui] = None
+                dst_ui._arcs[a_ui] = None
                 a_ui.update_position()
 
     def disconnect(self, src_ui, dst_ui):
@@ -201,22 +299,21 @@ class SimSimsGUI(Tk):
                 dst_ui: dst of an arc.
         '''
         # If the arc exists
-        arcs = [x for x in dst_ui._arcs if x._out == src_ui if x.bidirectional]
-        if arcs:
-            a_ui = arcs.pop()
+        a_ui = self._arc_index.get((dst_ui, src_ui))
+        if a_ui is not None and a_ui.bidirectional:
             a_ui.bidirectional = False
             a_ui._set_status(GUIComponent.STATUS_REDRAW)
 
-        arcs = [x for x in src_ui._arcs if x._out == dst_ui]
-        if arcs:
-            a_ui = arcs.pop()
+        a_ui = self._arc_index.pop((src_ui, dst_ui), None)
+        if a_ui is not None:
             if a_ui.bidirectional:
                 a_ui.reverse()
                 a_ui.bidirectional = False
                 a_ui._set_status(GUIComponent.STATUS_REDRAW)
+                self._arc_index[(dst_ui, src_ui)] = a_ui
             else:
-                src_ui._arcs.remove(a_ui)
-                dst_ui._arcs.remove(a_ui)
+                del src_ui._arcs[a_ui]
+                del dst_ui._arcs[a_ui]
                 a_ui._set_status(GUIComponent.STATUS_DELETE)
 
     def remove(self, gui):
@@ -227,6 +324,8 @@ class SimSimsGUI(Tk):
         gui._set_status(GUIComponent.STATUS_DELETE)
         if gui in self._uis:
             self._uis.remove(gui)
+        for a_ui in getattr(gui, "_arcs", ()):
+            self._arc_index.pop((a_ui._in, a_ui._out), None)
 
     def on_close(self, fkn):
         ''' Set function to call when UI signals a shoot '''
@@ -273,6 +372,7 @@ class GUIComponent:
     STATUS_DELETE = 0x02
     STATUS_DEFINE = 0x04
     STATUS_REDRAW = 0x08
+    _sunflowers = {}
 
     def __init__(self, canvas, properties):
         self._shapes = []
@@ -404,6 +504,17 @@ class GUIComponent:
 
     @classmethod
     def sunflower(cls, n, alpha, radius):
+        ''' Returns n points spread over a disc. Layouts are cached per
+            (n, alpha, radius), the returned list must not be changed. '''
+        key = (n, alpha, radius)
+        pairs = GUIComponent._sunflowers.get(key)
+        if pairs is None:
+            pairs = GUIComponent._sunflower(n, alpha, radius)
+            GUIComponent._sunflowers[key] = pairs
+        return pairs
+
+    @classmethod
+    def _sunflower(cls, n, alpha, radius):
         if n == 1:
             return [Coords(0.0, 0.0)]
         pairs = []
@@ -421,28 +532,44 @@ class GUIComponent:
 
 class GUINodeComponent(GUIComponent):
     ''' A node component in the gui.
+        Tokens are laid out on a sunflower with room for a few more
+        tokens than there are, see _layout_size. A token keeps its slot
+        until it is removed, then the last token takes over the slot,
+        so adding or removing a token moves at most one other token
+        unless the layout has to grow or shrink.
+        A node holding more than token_limit tokens is crowded. It hides
+        its tokens, so they have no Tk items, and shows their count.
         Args:
             canvas: Tk Canvas
             size: size of the node
             properties: properties for the object.
         Properties:
             tokens: number of tokens
+            token_limit: the most tokens drawn, above it only the count
+                is shown
     '''
+    TOKEN_LIMIT = 100
 
     def __init__(self, canvas, size, properties={}):
-        self._arcs = []
+        self._arcs = {}
         self._tokens = []
+        self._token_slots = {}
+        self._token_lock = Lock()
+        self._layout = []
+        self._crowded = False
+        self._badge = None
         self._font = None
         self._radius = size
         GUIComponent.__init__(self, canvas, properties)
 
     def __del__(self):
         for arc in copy(self._arcs):
-            arc._in._arcs.remove(arc)
-            arc._out._arcs.remove(arc)
+            arc._in._arcs.pop(arc, None)
+            arc._out._arcs.pop(arc, None)
 
             del arc
         self._tokens.clear()
+        self._token_slots.clear()
 
     @property
     def tokens(self):
@@ -454,9 +581,17 @@ class GUINodeComponent(GUIComponent):
             Args:
                 token_ui: UI of the token to add.
         '''
-        token_ui.position = Coords(0.0, 0.0)
-        self._tokens.append(token_ui)
-        self._reposition(self.position)
+        with self._token_lock:
+            slot = len(self._tokens)
+            self._token_slots[token_ui] = slot
+            self._tokens.append(token_ui)
+            if self._crowd_changed():
+                pass
+            elif self._crowded:
+                token_ui.visible = False
+                self._set_status(GUIComponent.STATUS_REDRAW)
+            elif not self._relayout():
+                self._place_token(slot)
 
     def remove_token(self, token_ui):
         ''' Remove a token UI to this node_ui.
@@ -464,8 +599,65 @@ class GUINodeComponent(GUIComponent):
                 token_ui: UI of the token to remove.
         '''
         token_ui.position = Coords(0.0, 0.0)
-        self._tokens.remove(token_ui)
-        self._reposition(self.position)
+        token_ui.visible = True
+        with self._token_lock:
+            slot = self._token_slots.pop(token_ui)
+            last = self._tokens.pop()
+            if last is not token_ui:
+                self._tokens[slot] = last
+                self._token_slots[last] = slot
+            if self._crowd_changed():
+                pass
+            elif self._crowded:
+                self._set_status(GUIComponent.STATUS_REDRAW)
+            elif not self._relayout() and last is not token_ui:
+                self._place_token(slot)
+
+    def _crowd_changed(self):
+        ''' Hides the tokens when the node becomes crowded and shows
+            them again when it no longer is. Returns True if it did. '''
+        crowded = self.tokens > self.properties["token_limit"]
+        if crowded == self._crowded:
+            return False
+        self._crowded = crowded
+        for token_ui in self._tokens:
+            token_ui.visible = not crowded
+        if not crowded:
+            self._relayout(force=True)
+        self._set_status(GUIComponent.STATUS_REDRAW)
+        return True
+
+    @staticmethod
+    def _layout_size(n):
+        ''' Returns the number of slots in the layout for n tokens.
+            Above 8 tokens it is rounded up to a quarter of the largest
+            power of two below n, so the layout changes rarely. '''
+        if n <= 8:
+            return n
+        step = (1 << ((n-1).bit_length()-1)) // 4
+        return -(-n // step) * step
+
+    def _relayout(self, force=False):
+        ''' Switches to the layout for the number of tokens if its size
+            changed, moving every token. Returns True if it did. '''
+        size = GUINodeComponent._layout_size(self.tokens)
+        if size == len(self._layout) and not force:
+            return False
+        self._layout = GUIComponent.sunflower(size, 1.0, 0.8*self._radius)
+        self._place_tokens()
+        return True
+
+    def _place_tokens(self):
+        ''' Moves every token to its place in the layout. '''
+        positions = Coords.translate_all(
+            self._layout[:self.tokens], self.position.x, self.position.y)
+        for token_ui, position in zip(self._tokens, positions):
+            token_ui.position = position
+
+    def _place_token(self, slot):
+        ''' Moves the token in a slot to its place in the layout. '''
+        self._tokens[slot].position = \
+            self._layout[slot].translate(self.position)
 
     def autoplace(self, index, n_places):
         ''' Place a graphical ui component.
@@ -487,13 +679,31 @@ class GUINodeComponent(GUIComponent):
         GUIComponent._define(self)
         self._font = font.Font(family='Arial', size=7)
 
+    def _delete(self):
+        GUIComponent._delete(self)
+        self._badge = None
+
+    def _update(self):
+        ''' Shows the number of tokens while crowded. '''
+        if self._crowded:
+            if self._badge is None:
+                self._badge = self.canvas.create_text(
+                    0.0, 0.0, font=self._font, justify=CENTER,
+                    fill=self.properties["color"])
+                self.shapes.append((self._badge, Coords(0.0, 0.0)))
+                self.canvas.coords(self._badge, self.position[:])
+            self.canvas.itemconfig(self._badge, text=str(self.tokens))
+        elif self._badge is not None:
+            self.shapes.remove((self._badge, Coords(0.0, 0.0)))
+            self.canvas.delete(self._badge)
+            self._badge = None
+
     def _reposition(self, args):
         GUIComponent._reposition(self, *args)
-        cps = GUIComponent.sunflower(self.tokens, 1.0, 0.8*self._radius)
 
         try:
-            for i in range(self.tokens):
-                self._tokens[i].position = cps[i].translate(self.position)
+            if not self._crowded:
+                self._place_tokens()
             for a in self._arcs:
                 a.update_position()
         except:
@@ -511,6 +721,8 @@ class GUINodeComponent(GUIComponent):
         GUIComponent._verify_properties(self, properties)
         if not "fill" in self.properties.keys():
             self.properties["fill"] = "#fff"
+        if not "token_limit" in self.properties.keys():
+            self.properties["token_limit"] = GUINodeComponent.TOKEN_LIMIT
 
 
 class GUIPlaceComponent(GUINodeComponent):
@@ -522,7 +734,8 @@ class GUIPlaceComponent(GUINodeComponent):
     def anchor_point(self, coord):
         ''' Overrides from GUINodeComponent. '''
         x1, y1 = self.position
-        x2, y2 = coord[0]-x1, coord[1]-y1
+        x2, y2 = coord
+        x2, y2 = x2-x1, y2-y1
         r = self._radius
         sr = sqrt(x2*x2 + y2*y2)
         if sr > 0:
@@ -531,7 +744,7 @@ class GUIPlaceComponent(GUINodeComponent):
         else:
             x = x1
             y = y1-r
-        return Coords(x+x1, y+y1)
+        return Coords._of((x+x1, y+y1))
 
     def _define(self):
         ''' Overrides from GUIComponent. '''
@@ -589,8 +802,9 @@ class GUITransitionComponent(GUINodeComponent):
 
     def anchor_point(self, coord):
         ''' Overrides from GUINodeComponent '''
-        x1, y1 = self.position.x, self.position.y
-        dx, dy = coord.x-x1, coord.y-y1
+        x1, y1 = self.position
+        x2, y2 = coord
+        dx, dy = x2-x1, y2-y1
         dxa, dya = abs(dx), abs(dy)
 
         if dxa < 0.0001 and dya < 0.0001:
@@ -607,7 +821,7 @@ class GUITransitionComponent(GUINodeComponent):
         if dy < 0.0:
             y = -y
 
-        return Coords(x+x1, y+y1)
+        return Coords._of((x+x1, y+y1))
 
 
 class GUITokenComponent(GUIComponent):
@@ -615,9 +829,24 @@ class GUITokenComponent(GUIComponent):
     BASE_LENGTH = 2.0
 
     def __init__(self, canvas, properties={}):
+        self._visible = True
         GUIComponent.__init__(self, canvas, properties)
 
+    @property
+    def visible(self):
+        ''' False while the token is hidden in a crowded node, it then
+            has no Tk item. '''
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible):
+        if visible != self._visible:
+            self._visible = visible
+            self._set_status(GUIComponent.STATUS_DEFINE)
+
     def _define(self):
+        if not self._visible:
+            return
         shape = self.canvas.create_oval(
             0.0, 0.0, 0.0, 0.0, fill=self.properties["color"], width=0, outline=self.properties["color"])
         self.canvas.tag_raise(shape)
@@ -652,15 +881,14 @@ class GUIArcComponent(GUIComponent):
     def reverse(self):
         tmp = self._in
         self._in = self._out
-        self._out = self._in
+        self._out = tmp
         self.position = Coords(self.position[2],self.position[3],self.position[0],self.position[1])
 
     def update_position(self):
         ''' Update the position of the arc's drawer '''
         coord1 = self._in.anchor_point(self._out.position)
         coord2 = self._out.anchor_point(self._in.position)
-        coords = Coords(coord1[0], coord1[1], coord2[0], coord2[1])
-        self.position = coords
+        self.position = Coords._of(coord1._coords + coord2._coords)
 
     def _reshape(self):
         if self.shapes:
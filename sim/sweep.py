@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from sim import ENGINE_EVENTS, TABLE_NAME, World
+from pydb import Analytics, SweepStore
+
+SWEEP_FILE = "sweep.db"
+DEFAULT_CONFIG = {"barrack_size": 3, "storage_size": 2, "barn_size": 2,
+                  "dining_halls_size": 4, "homes_size": 5, "fields_size": 5,
+                  "factories_size": 5, "workers_size": 50}
+
+
+def grid(**values: list) -> list[dict]:
+    """Returns every combination of the given World arguments,
+    with the rest taken from DEFAULT_CONFIG"""
+    keys = list(values.keys())
+    return [{**DEFAULT_CONFIG, **dict(zip(keys, combination))}
+            for combination in itertools.product(*values.values())]
+
+
+def run_world(run: int, seed: int, config: dict) -> tuple:
+    """Simulates one world in this process,
+    returns the run, firings per second and recorded steps"""
+    with tempfile.TemporaryDirectory() as directory:
+        sql_file = os.path.join(directory, "run.db")
+        world = World(**config, engine=ENGINE_EVENTS, sql_file=sql_file,
+                      xlsx_path=None, headless=True, seed=seed)
+        world.simulate()
+
+        analytics = Analytics(sql_file, TABLE_NAME)
+        steps = analytics.get_steps()
+        analytics.close()
+    return run, world.firings_per_second, steps
+
+
+def sweep(configs: list[dict], repeats: int = 1, seed: int = 0,
+          max_workers: int = None, path_db: str = SWEEP_FILE):
+    """Simulates every config a number of times over a process pool
+    and stores all runs in one database. Run n gets the seed seed+n"""
+    store = SweepStore(path_db)
+    store.create_tables()
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = {}
+        runs = itertools.product(configs, range(repeats))
+        for run, (config, _) in enumerate(runs):
+            future = executor.submit(run_world, run, seed + run, config)
+            futures[future] = (seed + run, config)
+
+        for future in as_completed(futures):
+            run, firings_per_second, steps = future.result()
+            run_seed, config = futures[future]
+            store.add_run(run, run_seed, json.dumps(config),
+                          firings_per_second, steps)
+            logging.info("Run %s done (%.0f firings/s)",
+                         run, firings_per_second)
+
+    store.close()
+    logging.info("%s runs in %.2f s", len(futures), time.time()-start_time)
+
+
+def main():
+    """Main function"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sweep(grid(workers_size=[25, 50, 100], homes_size=[3, 5, 8]), repeats=2)
+
+
+if __name__ == '__main__':
+    main()